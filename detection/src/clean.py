@@ -5,6 +5,7 @@
 
 import cv2
 import numpy as np
+from collections import defaultdict
 from geometry import *
 
 # Logging.
@@ -15,24 +16,15 @@ def log(message):
 # Obtains points which are positioned nearby the point according to 'distance'.
 def getNearbyPoints(point, points, distance):
 
-    # log("Point: " + str(point) + ". Points: " + str(points))
+    points = np.asarray(points).reshape(-1, 2)
 
-    nearbyX = getSimilarValuesWithinRange([x for x, y in points], point[0], distance)
-    nearbyY = getSimilarValuesWithinRange([y for x, y in points], point[1], distance)
-
-    log("NearbyX: " + str(nearbyX[:,1]))
-    log("NearbyY: " + str(nearbyY))
-
-    # Get intersection of indeces of points where the
-    # axis values which are 'distance' pixels away from the point
-    commonIndeces = np.intersect1d(nearbyX[:,1], nearbyY[:,1])
-
-    # Convert indeces to ints.
-    commonIndeces = [int(i) for i in commonIndeces]
+    # Get indeces of points where both axis values are within 'distance' pixels
+    # of the point.
+    commonIndeces = np.flatnonzero((np.abs(points[:, 0] - point[0]) <= distance) & (np.abs(points[:, 1] - point[1]) <= distance)).tolist()
 
     log("Common indeces: " + str(commonIndeces))
 
-    nearby = np.array(points)[commonIndeces] if len(commonIndeces) > 0 else []
+    nearby = points[commonIndeces] if len(commonIndeces) > 0 else []
 
     log("Nearby points from : " + str(point) + " : " + str(nearby))
 
@@ -44,77 +36,90 @@ def getNearbyEucPoints(point, points, distance):
     return [pt for pt in points if euclideanDistance(point, pt) <= distance]
 
 # Averages all points within 'distance' pixels of each other.
-# TODO: Optimise performance by ensuring we are not re-looping over points which
-# have already been averaged...
+#
+# Points are clustered greedily: the first point which has not yet been
+# clustered seeds a new cluster, which takes every other unclustered point within
+# 'distance' of it. Each cluster is replaced by the average of its points.
+# Neighbours are found through a grid hash, so each point is only compared with
+# the points in nearby cells instead of every other intersection.
 def filterOverlappingIntersections(intersections, distance):
 
-    filtered = []
+    if (len(intersections) == 0): return []
 
-    for point in intersections:
-        # toAverage, indeces = getNearbyPoints(point, intersections, distance)
-        toAverage = getNearbyEucPoints(point, intersections, distance)
+    points = np.array(intersections, dtype=float).reshape(-1, 2)
+    grid = PointGrid(points, max(distance, 1))
+    clustered = np.zeros(len(points), dtype=bool)
 
-        # Average points.
-        averagedX = round(np.mean([x for x, y in toAverage]))
-        averagedY = round(np.mean([y for x, y in toAverage]))
+    filtered = []
 
-        # log("Averaged poitn: " + )
-        filtered.append((averagedX, averagedY))
+    for i in range(0, len(points)):
 
-        log(len(filtered))
+        if (clustered[i]): continue
 
-    # Squash all unique points together.
-    filtered = list(set(filtered))
+        neighbours, _ = grid.query(points[i], distance)
+        cluster = neighbours[~clustered[neighbours]]
+        clustered[cluster] = True
+
+        # Average points.
+        averagedX, averagedY = points[cluster].mean(axis=0)
+        filtered.append((round(averagedX), round(averagedY)))
 
     log("Filtered: " + str(len(intersections) - len(filtered)) + " intersections within \
     a distance of " + str(distance)+".")
 
     return filtered
+
 # Given a set of contours, calculates the area for each contour and the midpoint.
 # Where two rectangles are detected with similar midpoints and slightly different
 # areas, then the larger of the two is kept.
+#
+# Shapes are visited in order and removed if a larger shape of the same type which
+# has not itself been removed lies within 'distanceThreshold' of it, with an area
+# ratio above 'areaPercentageThreshold'. Nearby shapes are found through a grid
+# hash of the midpoints, so each shape is only compared against its neighbours.
 def removeInnerRectangles(shapes, areaPercentageThreshold, distanceThreshold):
 
-    output = shapes.copy()
+    if (len(shapes) == 0 or distanceThreshold <= 0): return list(shapes)
 
-    for shape in output:
+    grid = PointGrid([ shape.midpoint for shape in shapes ], distanceThreshold)
+    areas = np.array([ shape.area for shape in shapes ], dtype=float)
 
-        # areaThreshold = shape.area * areaPercentageThreshold
-        # log("Distance threshold of " + str(distanceThreshold))
-        # log("Area threshold of " + str(areaThreshold) + " for " + str(shape))
+    # Shapes which compare equal are removed together, as they were when the
+    # output list was filtered by equality.
+    groups = defaultdict(list)
+    for i, shape in enumerate(shapes):
+        groups[getShapeKey(shape)].append(i)
 
-        # Find the distance from this shape and every other shape of the same kind.
-        for otherShape in output:
+    removed = np.zeros(len(shapes), dtype=bool)
 
-            # Skip iteration if otherShape is smaller than shape.
-            if (shape.area > otherShape.area): continue
-            if (shape.type != otherShape.type or shape == otherShape): continue
+    for i, shape in enumerate(shapes):
+
+        neighbours, distances = grid.query(shape.midpoint, distanceThreshold)
 
-            # areaDifference = abs(shape.area - otherShape.area)
-            distance = shape.distance(otherShape)
+        for j, distance in zip(neighbours, distances):
 
-            # print(shape)
-            # print(otherShape)
-            # print("Shape distance: " + str(distance))
-            # print("Dist thresh:" + str(distanceThreshold))
-            # print("Area "+str(shape) + " " + str(shape.area) + " , " + str(otherShape)+ " " + str(otherShape.area))
-            # print("Area ratio: "+ str(shape.area / otherShape.area))
-            # print("Raw area ratio: "+ str(shape.rawArea / otherShape.rawArea))
+            if (removed[j] or distance >= distanceThreshold): continue
+
+            # Only compare against larger shapes of the same kind.
+            otherShape = shapes[j]
+            if (areas[i] > areas[j] or areas[j] == 0): continue
+            if (shape.type != otherShape.type or shape == otherShape): continue
 
             # If the rectangles are similar, keep the larger one. It is desired
             # that the outermost bounding rectangle is kept in order to represent
             # containers as accurately as possible.
-            if (shape.area / otherShape.area > areaPercentageThreshold and distance < distanceThreshold):
-
-                log("Area Ration between " + str(shape) +"("+str(shape.area)+")" + " and " + str(otherShape) + "("+str(otherShape.area)+")"+ ": " + str(shape.area / otherShape.area))
-                log("Distance between " + str(shape) + " and " + str(otherShape) + ": " + str(distance)+". Threshold: "+ str(distanceThreshold))
-                log("Midpoint " + str(shape) + " : " + str(shape.midpoint) + ", Midpoint " + str(otherShape) + ": " + str(otherShape.midpoint))
+            if (areas[i] / areas[j] > areaPercentageThreshold):
                 log("["+str(shape)+"]"+ " and " + "["+str(otherShape)+"]" + " deemed to be similar. Removing ["+str(shape)+"]")
+                removed[groups[getShapeKey(shape)]] = True
+                break
 
-                output = [ s for s in output if s != shape ]
+    return [ shape for i, shape in enumerate(shapes) if not removed[i] ]
 
-                log("Resulting output: " + str(output))
-    return output
+# Returns a hashable key which is equal for shapes which compare equal.
+def getShapeKey(shape):
+    rawVertices = np.asarray(shape.rawVertices)
+    vertices = np.asarray(shape.vertices)
+    return (shape.type, rawVertices.shape, rawVertices.tobytes(), vertices.shape, vertices.tobytes())
 
 # Removes fragments which are smaller than 1% of the size of the container.
 def removeContainingFragments(container, shapes):
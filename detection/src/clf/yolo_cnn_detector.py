@@ -8,6 +8,7 @@ import os
 import argparse
 import imutils
 import numpy as np
+import threading
 
 _MODULE_PATH = os.path.dirname(__file__) if os.path.dirname(__file__) is not "" else "."
 _BASE_PATH = _MODULE_PATH+'/PrimitiveDetect/darknet-tiny-yolo'
@@ -15,11 +16,28 @@ _CONFIG_FILE = _BASE_PATH+'/custom/yolov3-tiny.cfg'
 _OBJECT_NAMES = _BASE_PATH+'/custom/objects.names'
 _WEIGHTS_FILE = _BASE_PATH+'/backup/yolov3-tiny.backup'
 _CONFIDENCE_THRESHOLD = 0.5
+_INPUT_SIZE = 416
+# Tiled inference: side length of each (square) tile in image pixels, and the
+# fraction by which neighbouring tiles overlap.
+_TILE_SIZE = 416
+_TILE_OVERLAP = 0.25
+# Upper bound on the number of tiles per image; tiles are grown for larger
+# images so that cost stays bounded. Tiles are run through the network in
+# batches of at most _TILE_BATCH_SIZE images.
+_MAX_TILES = 16
+_TILE_BATCH_SIZE = 8
 
 # Read in names file and split by newline so that we can index it with the corresponding
 # class id.
 names = open(_OBJECT_NAMES, 'r').read().split('\n')
 
+# Process-wide model registry. The network and its output layer names are loaded
+# once on first use (or explicitly via warmUp) and then shared across every call
+# to predict_primitives, instead of re-parsing the cfg and weights per image.
+_yolo_net = None
+_output_layers = None
+_net_lock = threading.Lock()
+
 # Draws predictions on screen
 def draw_pred(img, class_id, confidence, x, y, x_plus_w, y_plus_h):
 
@@ -46,31 +64,51 @@ def getOutputsNames(net):
     # print("Output layers for YOLOV3Tiny: " + str(outputLayers))
     return outputLayers
 
+# Returns the shared YOLO network along with its output layer names, loading
+# them from disk the first time this is called in the process.
+def getNetwork():
+    global _yolo_net, _output_layers
+    if (_yolo_net is None):
+        with _net_lock:
+            if (_yolo_net is None):
+                net = cv2.dnn.readNetFromDarknet(_CONFIG_FILE, _WEIGHTS_FILE)
+                _output_layers = getOutputsNames(net)
+                _yolo_net = net
+    return _yolo_net, _output_layers
+
+# Loads the network ahead of the first request (e.g. on server start) and runs
+# a single forward pass on a blank image so that OpenCV allocates its buffers
+# up front.
+def warmUp():
+    blank = np.zeros((416, 416, 3), dtype=np.uint8)
+    predict_primitives(blank, blank.shape)
+
 def processCNNOutput(outs, conf_threshold, Width, Height):
 
-    class_ids = []
-    confidences = []
-    boxes = []
-
-    for layer in outs:
-        # print(detection)
-        for detection in layer:
-            # print("Detection: "+ str(detection[0]))
-            # Each detection has the form [center_x center_y width height obj_score class_1_score class_2_score ..]
-            scores = detection[5:] # Classes scores starts from index 5
-            class_id = np.argmax(scores)
-            confidence = scores[class_id]
-            if confidence > conf_threshold:
-                center_x = int(detection[0] * Width)
-                center_y = int(detection[1] * Height)
-                w = int(detection[2] * Width)
-                h = int(detection[3] * Height)
-                x = int(center_x - w / 2)
-                y = int(center_y - h / 2)
-                class_ids.append(class_id)
-                confidences.append(float(confidence))
-                boxes.append([x, y, w, h])
-    return boxes, confidences, class_ids
+    # Stack the detections from every output layer into a single array. Each
+    # detection has the form [center_x center_y width height obj_score class_1_score class_2_score ..]
+    if (len(outs) == 0): return [], [], []
+    detections = np.concatenate([ layer.reshape(-1, layer.shape[-1]) for layer in outs ])
+
+    scores = detections[:, 5:] # Classes scores starts from index 5
+    class_ids = np.argmax(scores, axis=1)
+    confidences = scores[np.arange(len(detections)), class_ids]
+
+    # Only keep detections above the confidence threshold.
+    mask = confidences > conf_threshold
+    detections, class_ids, confidences = detections[mask], class_ids[mask], confidences[mask]
+
+    # Scale boxes to the canvas, truncating towards zero in the same way as int().
+    center_x = (detections[:, 0] * Width).astype(int)
+    center_y = (detections[:, 1] * Height).astype(int)
+    w = (detections[:, 2] * Width).astype(int)
+    h = (detections[:, 3] * Height).astype(int)
+    x = (center_x - w / 2).astype(int)
+    y = (center_y - h / 2).astype(int)
+
+    boxes = np.stack([x, y, w, h], axis=1).tolist()
+
+    return boxes, confidences.astype(float).tolist(), class_ids.tolist()
 
 def applyNonMaxSupression(boxes, confidences, class_ids, conf_threshold, nms_threshold):
 
@@ -104,9 +142,8 @@ def predict_primitives(image, canvasShape, conf_threshold = _CONFIDENCE_THRESHOL
 
     if (canvasShape is None): canvasShape = image.shape
 
-    # Load the neural network weights & config.
-    # yolo_net = cv2.dnn.readNetFromDarknet(_WEIGHTS_FILE, _CONFIG_FILE)
-    yolo_net = cv2.dnn.readNetFromDarknet(_CONFIG_FILE, _WEIGHTS_FILE)
+    # Fetch the shared network (loaded once per process).
+    yolo_net, outputLayers = getNetwork()
 
     # Read in a sample image.
     # image = imutils.resize(image, width=300)
@@ -116,16 +153,132 @@ def predict_primitives(image, canvasShape, conf_threshold = _CONFIDENCE_THRESHOL
 
     # Compute the blob; essentially a form of preprocessing on the image necessary
     # to be passed into YOLOv3.
-    blob = cv2.dnn.blobFromImage(image, 1/255.0, (416,416), [0,0,0], True, crop=False)
+    blob = cv2.dnn.blobFromImage(image, 1/255.0, (_INPUT_SIZE,_INPUT_SIZE), [0,0,0], True, crop=False)
     Width = image.shape[1]
     Height = image.shape[0]
-    yolo_net.setInput(blob)
 
-    # Calculate outputs.
-    # outs = yolo_net.forward()
-    outs = yolo_net.forward(getOutputsNames(yolo_net))
+    # Calculate outputs. The network holds its input as state, so concurrent
+    # requests must not interleave setInput and forward.
+    with _net_lock:
+        yolo_net.setInput(blob)
+        outs = yolo_net.forward(outputLayers)
     # print(len(outs[1]))
 
+    return resolvePrimitives(outs, canvasShape, conf_threshold, nms_threshold)
+
+# Runs a batch of images through the network in a single forward pass, returning
+# a list containing the predicted primitives for each image (in the same order
+# and format as predict_primitives).
+def predict_primitives_batch(images, canvasShapes=None, conf_threshold = _CONFIDENCE_THRESHOLD, nms_threshold = 0.1):
+
+    if (len(images) == 0): return []
+
+    if (canvasShapes is None): canvasShapes = [ None ] * len(images)
+    canvasShapes = [ image.shape if canvasShape is None else canvasShape for image, canvasShape in zip(images, canvasShapes) ]
+
+    outs = forwardBatch(images)
+
+    return [
+        resolvePrimitives(outs[i], canvasShapes[i], conf_threshold, nms_threshold)
+        for i in range(0, len(images))
+    ]
+
+# Runs the images passed through the network, in forward passes of at most
+# 'batchSize' images (all at once if None), returning the list of output layers
+# for each image.
+def forwardBatch(images, batchSize=None):
+
+    if (batchSize is not None and len(images) > batchSize):
+        return [ outs for i in range(0, len(images), batchSize) for outs in forwardBatch(images[i:i+batchSize]) ]
+
+    yolo_net, outputLayers = getNetwork()
+
+    # Each image is resized to the network input size, so images of differing
+    # dimensions can share the same blob.
+    blob = cv2.dnn.blobFromImages(images, 1/255.0, (_INPUT_SIZE,_INPUT_SIZE), [0,0,0], True, crop=False)
+
+    with _net_lock:
+        yolo_net.setInput(blob)
+        outs = yolo_net.forward(outputLayers)
+
+    # Split each output layer back into per-image detections. Depending on the
+    # batch size, OpenCV returns each layer either as (rows, attrs) or as
+    # (batch, rows, attrs), so we normalise to the latter.
+    outs = [ layer.reshape(len(images), -1, layer.shape[-1]) for layer in outs ]
+
+    return [ [ layer[i] for layer in outs ] for i in range(0, len(images)) ]
+
+# Returns the (x, y, w, h) regions of overlapping square tiles covering an image
+# of the size passed. The last tile along each axis is aligned with the edge of
+# the image, so tiles never extend past it. If more than 'maxTiles' tiles would
+# be needed, the tile size is grown until they fit.
+def getTiles(width, height, tileSize=_TILE_SIZE, overlap=_TILE_OVERLAP, maxTiles=_MAX_TILES):
+
+    tiles = getTilesOfSize(width, height, tileSize, overlap)
+    while (maxTiles is not None and len(tiles) > maxTiles):
+        tileSize = int(tileSize * 1.25) + 1
+        tiles = getTilesOfSize(width, height, tileSize, overlap)
+    return tiles
+
+def getTilesOfSize(width, height, tileSize, overlap):
+
+    step = max(int(tileSize * (1 - overlap)), 1)
+
+    def getOffsets(length):
+        if (length <= tileSize): return [0]
+        offsets = list(range(0, length - tileSize + 1, step))
+        if (offsets[-1] != length - tileSize): offsets.append(length - tileSize)
+        return offsets
+
+    return [
+        (x, y, min(tileSize, width), min(tileSize, height))
+        for y in getOffsets(height) for x in getOffsets(width)
+    ]
+
+# Tiled variant of predict_primitives for large canvases, where small primitives
+# would be lost when the whole image is squashed into the network input. The
+# image is split into at most _MAX_TILES overlapping tiles which, along with the
+# whole image (to keep primitives larger than a tile), are run through the
+# network in batches of _TILE_BATCH_SIZE. Boxes are offset back into canvas coordinates and
+# duplicates along tile seams are merged with non-max suppression.
+def predict_primitives_tiled(image, canvasShape=None, conf_threshold = _CONFIDENCE_THRESHOLD, nms_threshold = 0.1, tileSize=_TILE_SIZE, overlap=_TILE_OVERLAP):
+
+    if (canvasShape is None): canvasShape = image.shape
+
+    height, width = image.shape[:2]
+    tiles = getTiles(width, height, tileSize, overlap)
+
+    # Small images fit in a single tile, so there is nothing to gain.
+    if (len(tiles) == 1): return predict_primitives(image, canvasShape, conf_threshold, nms_threshold)
+
+    # Scale from image pixels to canvas pixels.
+    scaleX = canvasShape[1] / width
+    scaleY = canvasShape[0] / height
+
+    regions = [ (0, 0, width, height) ] + tiles
+    outs = forwardBatch([ image ] + [ image[y:y+h, x:x+w] for x, y, w, h in tiles ], _TILE_BATCH_SIZE)
+
+    boxes, confidences, class_ids = [], [], []
+
+    for (x, y, w, h), regionOuts in zip(regions, outs):
+        regionBoxes, regionConfidences, regionClassIds = processCNNOutput(regionOuts, conf_threshold, w * scaleX, h * scaleY)
+        offsetX, offsetY = int(round(x * scaleX)), int(round(y * scaleY))
+        boxes += [ [bx + offsetX, by + offsetY, bw, bh] for bx, by, bw, bh in regionBoxes ]
+        confidences += regionConfidences
+        class_ids += regionClassIds
+
+    boxes, confidences, class_ids = applyNonMaxSupression(boxes, confidences, class_ids, conf_threshold, nms_threshold)
+
+    boxesAsVertexLists = [ convertBoxToVertex(box) for box in boxes ]
+
+    labels = [ names[class_id] for class_id in class_ids ]
+
+    return [ primitive for primitive in zip(boxes, boxesAsVertexLists, labels, class_ids, confidences) ]
+
+# Converts the raw network outputs for a single image into a list of
+# (box, vertices, label, class_id, confidence) primitives, scaled to the canvas.
+def resolvePrimitives(outs, canvasShape, conf_threshold, nms_threshold):
+
     boxes, confidences, class_ids = processCNNOutput(outs, conf_threshold, canvasShape[1], canvasShape[0])
 
     boxes, confidences, class_ids = applyNonMaxSupression(boxes, confidences, class_ids, conf_threshold, nms_threshold)
@@ -10,8 +10,10 @@ import math
 import importlib
 from geometry import euclideanDistance
 from shape import Shape
-from isect_segments_bentley_ottmann import poly_point_isect as bot
+from shapeHierarchy import ContainmentIndex
+from segmentIntersect import findSegmentIntersections
 from clean import filterOverlappingIntersections
+from preprocess import preprocess
 from shape import *
 
 _DEBUG = False
@@ -32,142 +34,74 @@ def log(message):
 #         output.append((x, y))
 #     return output
 
-# Looks through shapes and nests the intersection within the shape of highest
-# nesting level. Returns the highest level shape containing the intersection.
-def nestIntersection(intersection, shapes):
-
-    if (len(shapes) == 0): return None
-
-    # Notion of not having a containing shape.
-    highestLevelShape = Shape([(-1,-1)])
-    highestLevelShape.level = -1
-
-    for shape in shapes:
-
-        if shape.containsPoint(intersection) and shape.level > highestLevelShape.level:
-            highestLevelShape = shape
-            log(str(shape) + " contains " + str(intersection))
-
-        if highestLevelShape.level == -1: continue
-
-        # Check recursively for shapes which are contained.
-        highestLevelShapeContained = nestIntersection(intersection, highestLevelShape.contained)
-
-        if (highestLevelShapeContained is not None): highestLevelShape = highestLevelShapeContained
-
-    return highestLevelShape if highestLevelShape.level != -1 else None
-
-# Looks through the shapes and returns shape of highest level such
-# that the shape contains the line at its vertical centre.
-def getHighestLvlShapeContainingLineAtCentre(line, shapes):
-
-    if (len(shapes) == 0): return None
-
-    # Notion of not having a containing shape.
-    highestLevelShape = Shape([-1,-1])
-    highestLevelShape.level = -1
-    highestLevelShape.id = "NULL"
-    highestLevelShape.type = "NULL"
-
-    for shape in shapes:
-
-        # Check if shape contains the line.
-        if shape.contains(line):
-
-            # Get the highest level shape recursively from contained components.
-            highestLevelContainedShape = getHighestLvlShapeContainingLineAtCentre(line, shape.contained)
-
-            if (line.id == 40): log(str(shape)+": Highest level shape containing line: " + str(highestLevelContainedShape))
-
-            if highestLevelContainedShape is None: highestLevelContainedShape = highestLevelShape
-
-            # Ensure that the line is roughly around the vertical centre of the
-            # containing shape. For this to be the case, the line must reside
-            # within 10% of the vertical height (in pixels) of the midpoint
-            # of the shape.
-            if abs(line.midpoint[1] - shape.midpoint[1]) <= (0.1 * shape.height):
-
-                # New shape candidate.
-                if shape.level > highestLevelShape.level: highestLevelShape = shape
-
-            # Check that any contained shapes do not contain the line at some
-            # higher nesting level.
-            if highestLevelContainedShape.level > highestLevelShape.level:
-                highestLevelShape = highestLevelContainedShape
-
-                # if (shape.id == "4"):
-                #     log(highestLevelShape.level)
-
-    if (line.id == 40 or line.id == "40"):
-        log("Shape " + str(highestLevelShape) + " contains line at centre.")
-
-    return highestLevelShape if highestLevelShape.level != -1 else None
-
-
-# The same as the method above, except the intersections are added the shape of highest
-# nest level where the intersection is located roughly around the center.
-def nestCenteredIntersection(intersection, shapes):
-
-    if (len(shapes) == 0): return None
-
-    # Notion of not having a containing shape.
-    highestLevelShape = Shape([(-1,-1)])
-    highestLevelShape.level = -1
-
-    # log(shapes)
-
-    for shape in shapes:
-
-        # Only interested in assigning centered intersections into prospective
-        # containers.
-        # if not shape.type == "rectangle": continue
-        if not shape.containsPoint(intersection): continue
-
-        log("Checking if " + str(intersection) + " centered within " + str(shape))
-
-        # Recursively examine all the contained shapes to extract the containing shape
-        # with the highest level.
-        highestLevelShapeContainingCenteredPoint = nestCenteredIntersection(intersection, shape.contained)
-        # Reassign to shape with same level as highestLevelShape if method returns
-        # None.
-        highestLevelShapeContainingCenteredPoint = \
-            highestLevelShape if highestLevelShapeContainingCenteredPoint is None \
-            else highestLevelShapeContainingCenteredPoint
-
-        # Check to see if the current shape is a candidate for housing the intersection
-        # at its centre. If so, we assign it to the 'higehstLevelShape'. It will get
-        # compared and replaced by any higher level shapes in the comparison
-        # below.
-        if (shape.level > highestLevelShape.level \
-            and euclideanDistance(shape.midpoint, intersection) <= 25):
-            highestLevelShape = shape
-
-        # Check recursively for shapes which are contained.
-        # highestLevelShapeContained = nestCenteredIntersection(intersection, highestLevelShape.contained)
-
-        # If both the current shape and any of its contained children do not house
-        # the intersection at their centre, we skip the iteratin.
-        if highestLevelShape.level == -1 \
-         and highestLevelShapeContainingCenteredPoint.level == -1: continue
-
-        # If highestLevelShapeContainingCenteredPoint is assigned a value, then it
-        # will be of a higher level, and so we can make this the highestLevelShape
-        # and return it.
-        if (highestLevelShapeContainingCenteredPoint.level > highestLevelShape.level):
-            highestLevelShape = highestLevelShapeContainingCenteredPoint
-
-    # log("Found centered shape: " + str(highestLevelShape if highestLevelShape.level != -1 else None))
-    return highestLevelShape if highestLevelShape.level != -1 else None
-
-def nestIntersections(intersections, shapes, image, lastShapeId, annotate):
+# Batch lookups over a ContainmentIndex of the shapes, built once for all the
+# points or lines being nested, returning the index row of the shape found for
+# each point or line, or -1.
+
+# Looks through the shapes and returns the row of the shape of highest nesting
+# level containing each point, descending into the first containing shape at
+# every level.
+def getContainingRows(index, points):
+    return index.getFirstDeepest(index.getContainingMask(points))
+
+# The same as the method above, except that the shape of highest level is picked
+# among those whose midpoint is within 25 pixels of the point, i.e. where the
+# point is located roughly around the centre.
+def getRowsContainingPointsAtCentre(index, points):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    containing = index.getContainingMask(points)
+
+    # Only the distances to the containing shapes are needed.
+    pointRows, shapeRows = np.nonzero(containing)
+    containing[pointRows, shapeRows] = np.linalg.norm(index.midpoints[shapeRows] - points[pointRows], axis=1) <= 25
+
+    return index.getHighestLevel(containing)
+
+# Looks through the shapes and returns the row of the shape of highest level
+# such that the shape contains each line at its vertical centre: the line must
+# reside within 10% of the vertical height (in pixels) of the midpoint of the
+# shape.
+def getRowsContainingLinesAtCentre(index, lines):
+    if (len(lines) == 0): return np.full(0, -1)
+
+    # A shape contains a line if it contains all of the line's vertices.
+    vertexCounts = [ len(line.vertices) for line in lines ]
+    vertexMask = index.getContainingMask(np.concatenate([ np.asarray(line.vertices).reshape(-1, 2) for line in lines ]))
+    containing = np.logical_and.reduceat(vertexMask, np.cumsum([0] + vertexCounts[:-1]), axis=0)
+
+    midpoints = np.array([ line.midpoint[1] for line in lines ], dtype=float)
+    lineRows, shapeRows = np.nonzero(containing)
+    containing[lineRows, shapeRows] = np.abs(midpoints[lineRows] - index.midpoints[shapeRows, 1]) <= (0.1 * index.heights[shapeRows])
+
+    return index.getHighestLevel(containing)
+
+# Nests each intersection within the shape of highest nesting level containing
+# it, and within the shape of highest level containing it around its centre.
+# If a LabelMap of the shapes is passed, the innermost shape containing each
+# intersection is read from it (to the nearest pixel) instead. If a
+# ContainmentIndex of the shapes is passed it is used for the lookups, rather
+# than building one.
+def nestIntersections(intersections, shapes, image, lastShapeId, annotate, labelMap=None, index=None):
+
+    if (len(intersections) == 0 or len(shapes) == 0): return shapes
+
+    # Look up the containing shapes for all intersections at once. Intersection
+    # shapes never contain other shapes, so nesting them does not affect the
+    # lookups.
+    index = ContainmentIndex(shapes) if index is None else index
+    if (labelMap is not None):
+        containingShapes = labelMap.getShapes(intersections)
+    else:
+        containingShapes = index.getShapes(getContainingRows(index, intersections))
+    centeredShapes = index.getShapes(getRowsContainingPointsAtCentre(index, intersections))
 
     idIndex = lastShapeId
     for i in range(0, len(intersections)):
 
         intersection = intersections[i]
 
-        highestLevelContainingShape = nestIntersection(intersection, shapes)
-        highestLevelShapeContainingIntAtCentre = nestCenteredIntersection(intersection, shapes)
+        highestLevelContainingShape = containingShapes[i]
+        highestLevelShapeContainingIntAtCentre = centeredShapes[i]
 
         # Intersection could not be nested.
         if (highestLevelContainingShape is None):
@@ -195,6 +129,7 @@ def nestIntersections(intersections, shapes, image, lastShapeId, annotate):
     return shapes
 
 def drawIntersections(intersections, image, annotate):
+    if (not annotate): return image
     log("Drawing " + str(len(intersections)) + " intersections.")
     for inter in intersections:
         drawPoint(inter, image)
@@ -210,11 +145,12 @@ def drawPoint(point, image):
     return image
 
 # Detects intersections and nests them within shapes that contain the intersection
-# points of the highest nesting level.
-def detectAndNestIntersections(image, shapes, lastShapeId, annotate):
+# points of the highest nesting level. A ContainmentIndex of the shapes may be
+# passed, so that it can be shared with detectAndNestLines.
+def detectAndNestIntersections(image, shapes, lastShapeId, annotate, preprocessed=None, labelMap=None, index=None):
 
     # Detect lines.
-    lines = detectLines(image)
+    lines = detectLines(image, preprocessed=preprocessed)
 
     # Detect intersections.
     intersections = detectIntersections(lines)
@@ -222,29 +158,18 @@ def detectAndNestIntersections(image, shapes, lastShapeId, annotate):
     # Draw intersections on image.
     image = drawIntersections(intersections, image, annotate)
 
-    return nestIntersections(intersections, shapes, image, lastShapeId, annotate), intersections, image
+    return nestIntersections(intersections, shapes, image, lastShapeId, annotate, labelMap, index), intersections, image
 
 # Given a list of lines extracted from an image, calculates the points at which
-# intersections between the lines take place, using the Bentley Ottman algorithm.
-# Ref: https://github.com/ideasman42/isect_segments-bentley_ottmann
-# TODO: Develop an understanding of how the algorithm works for the writeup.
+# intersections between the lines take place. Lines are bucketed into a grid and
+# only lines sharing a cell are tested against each other (see segmentIntersect).
 def detectIntersections(lines):
 
-    points = []
-
-    if (lines is not None):
-        for line in lines:
-            # Convert lines obtained from HoughLinesP into a tuple of two points each
-            # defined with floats instead of ints.
-            for x1, y1, x2, y2 in line:
-                points.append(((x1 + 0.0, y1 + 0.0), (x2 + 0.0, y2 + 0.0)))
+    # Lines obtained from HoughLinesP are (n, 1, 4) arrays of integer endpoints.
+    segments = np.asarray(lines, dtype=float).reshape(-1, 4) if lines is not None else np.zeros((0, 4))
 
     # Calculate intersections.
-    try:
-        intersections = bot.isect_segments(points)
-    except:
-        log("Could not find intersections for " + str(len(lines)) + " detected.")
-        intersections = []
+    intersections = findSegmentIntersections(segments)
 
     # Filter intersections within a window defined by the size of the image.
     # Intersections which are positions close to each other are averaged out.
@@ -273,7 +198,10 @@ def drawHorizontalLines(lines, image, colour = (100,200,0)):
 
     return image
 
-def nestCenteredLines(lines, shapes, image, lastShapeId, annotate):
+# Nests each horizontal line within the shape of highest level containing it at
+# its vertical centre. If a ContainmentIndex of the shapes is passed it is used
+# for the lookups, rather than building one.
+def nestCenteredLines(lines, shapes, image, lastShapeId, annotate, index=None):
 
     if lines is None: lines = []
 
@@ -281,17 +209,24 @@ def nestCenteredLines(lines, shapes, image, lastShapeId, annotate):
 
     centered_lines = []
 
+    # Skip lines which are not horizontal.
+    horizontalLines = []
     for rawLine in lines:
         x1, y1, x2, y2 = rawLine.ravel()
         line = Shape([[x1, y1], [x2, y2]], shapeType="centered_line", id=idIndex)
-
-        # Skip if the line is not horizontal.
         if line.height > 5: continue
-
         idIndex += 1
+        horizontalLines.append((rawLine, line))
+
+    if (len(horizontalLines) == 0 or len(shapes) == 0): return shapes, centered_lines
 
-        # Get highest level containing shape (at centre)
-        containingShape = getHighestLvlShapeContainingLineAtCentre(line, shapes)
+    # Get highest level containing shape (at centre) for all lines at once.
+    # Line shapes nested below are not treated as containers for later lines.
+    index = ContainmentIndex(shapes) if index is None else index
+    containingShapes = index.getShapes(getRowsContainingLinesAtCentre(index, [ line for _, line in horizontalLines ]))
+
+    for (rawLine, line), containingShape in zip(horizontalLines, containingShapes):
+        x1, y1, x2, y2 = rawLine.ravel()
 
         if containingShape is None: continue
 
@@ -307,14 +242,12 @@ def nestCenteredLines(lines, shapes, image, lastShapeId, annotate):
             drawPoint((x2, y2), image)
             cv2.putText(image, str(line), (x2, y2), cv2.FONT_HERSHEY_SIMPLEX, 0.3, (50,50,50))
 
-
-
     return shapes, centered_lines
 
-def detectAndNestLines(image, shapes, lastShapeId, annotate, debug=False):
+def detectAndNestLines(image, shapes, lastShapeId, annotate, debug=False, preprocessed=None, index=None):
 
     # Detect lines.
-    lines = detectLines(image, erode=False)
+    lines = detectLines(image, erode=False, preprocessed=preprocessed)
 
     # Draw the lines.
     # if annotate: drawLines(lines, image, colour=(100,200,0))
@@ -324,7 +257,7 @@ def detectAndNestLines(image, shapes, lastShapeId, annotate, debug=False):
     # cv2.waitKey(0)
 
     # Nest lines within shapes.
-    shapes, centered_lines = nestCenteredLines(lines, shapes, image, lastShapeId, annotate)
+    shapes, centered_lines = nestCenteredLines(lines, shapes, image, lastShapeId, annotate, index)
 
     # Annotate the centered lines.
     if annotate: drawLines(centered_lines, image, (255, 0, 0))
@@ -332,29 +265,16 @@ def detectAndNestLines(image, shapes, lastShapeId, annotate, debug=False):
     # Return shapes, lines and image.
     return shapes, lines, image
 
-def detectLines(image, debug=False, erode=True):
+# Detects the line segments in the image passed. The binarised and blurred
+# image is taken from 'preprocessed' if passed, so it can be shared with other
+# detectors working on the same image.
+def detectLines(image, debug=False, erode=True, preprocessed=None):
 
         imgHeight, imgWidth, channels = image.shape
 
-        # Convert the image to grayscale.
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-
-        # Blur the image with a gaussian kernel.
-        # We do this in order to filter through and reduce some of the noise we are
-        # recieving.
-        # blur = cv2.GaussianBlur(gray,( 5, 5), 0)
-
-        # Using otsu's binarisation.
-        # This works by analysing the image histogram, a distribution of the particular
-        # tones in an image. Each bar represents the frequency of pixels corresponding
-        # to that particular tone.
-        ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-
-        # Invert the image so that our desired shapes are highlighted in white.
-        invert = cv2.bitwise_not(thresh)
-
-        # Blur the image.
-        blurred = cv2.GaussianBlur(invert, (5,5), 0)
+        # Binarise the image so that our desired shapes are highlighted in white,
+        # then blur it with a gaussian kernel.
+        blurred = preprocess(image, preprocessed).blurred
 
         if (debug): cv2.imwrite('blurred.png', blurred)
 
@@ -374,8 +294,6 @@ def detectLines(image, debug=False, erode=True):
         # Canny edge detection.
         canny = cv2.Canny(preCannyImage, 100, 200)
 
-        cont2, hierarchy2 = cv2.findContours(canny, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-
         # Detect lines.
         # The 2nd last paramter is the minimum line length, while the lat parameter
         # refers to the maximum gap between lines to warrant a 'grouping'.
@@ -13,6 +13,8 @@ import math
 from clean import *
 from util import *
 from shape import Shape, nestShapes, nestWithinWindow
+from shapeHierarchy import LabelMap
+from preprocess import preprocess
 
 _DEBUG = False
 _LINE_THICKNESS = 2
@@ -39,41 +41,25 @@ def filterContours(contours, imageSize):
 def fillGaps(contours):
     return [ cv2.convexHull(np.array(cont)) for cont in contours ]
 
-def getContainers(image, annotate=False):
+# Detects the containers in the image passed. Grayscale, threshold and inversion
+# are taken from 'preprocessed' if passed, so they can be shared with other
+# detectors working on the same image.
+# If 'labelMap' is True, a LabelMap of the nested shapes, mapping each pixel of
+# the image to its innermost containing shape, is returned as well (or None).
+def getContainers(image, annotate=False, preprocessed=None, labelMap=False):
 
     imgHeight, imgWidth, channels = image.shape
 
-    # Convert the image to grayscale.
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Binarise the image, highlighting our desired shapes in white.
+    preprocessed = preprocess(image, preprocessed)
 
-    # Blur the image with a gaussian kernel.
-    # We do this in order to filter through and reduce some of the noise we are
-    # recieving.
-    # blur = cv2.GaussianBlur(gray,( 5, 5), 0)
-
-    # Using otsu's binarisation.
-    # This works by analysing the image histogram, a distribution of the particular
-    # tones in an image. Each bar represents the frequency of pixels corresponding
-    # to that particular tone.
-    ret, thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
-
-    # Invert the image so that our desired shapes are highlighted in white.
-    invert = cv2.bitwise_not(thresh)
-
-    # Canny edge detection.
-    canny = cv2.Canny(image, 100, 200, apertureSize=5)
-    # cv2.Canny(im)
-    # print("Detecting contours for image: " +str(canny))
-    cont2, hierarchy2 = cv2.findContours(canny, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    # cv2.drawContours(image, cont2, -1, (255,0,0))
-
-    # Finding contours based off of the result of the Canny edge detection.
+    # Finding contours based off of the inverted threshold image.
     # Contour detection in OpenCV finds contours which are white, on a BLACK background.
     # The output of this is a numpy array of (x,y) coordinates of the boundary points
     # of the contours.
     # CHAIN_APPROX_SIMPLE compresses the contours by only storing minimal information
     # about how to represent the lines that make it up (e.g. the endpoints of the lines).
-    contours, hierarchy = cv2.findContours(invert, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    contours, hierarchy = cv2.findContours(preprocessed.invert, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     # cv2.drawContours(image, contours, -1, (255,0,0))
 
     log("Found: "+ str(len(contours))+ " contours.")
@@ -114,8 +100,6 @@ def getContainers(image, annotate=False):
     # print([cv2.contourArea(shape.vertices) for shape in shapes])
     shapes = removeInnerRectangles(shapes, 0.7, distanceThreshold)
 
-    whiteImg = createWhiteImg((imgHeight, imgWidth))
-
     # Nest the shapes within each other and ensure all live within a global window.
     shapes = nestShapes(shapes)
 
@@ -132,12 +116,19 @@ def getContainers(image, annotate=False):
     # Sort shapes by vertical position.
     shapes = sortShapesInVerticalAscendingOrder(shapes)
 
-    # Annotate nested shapes if desired.
+    # Annotate nested shapes if desired. The blank canvas is only allocated when
+    # annotating.
+    whiteImg = None
     if (annotate):
+        whiteImg = createWhiteImg((imgHeight, imgWidth))
         annotateNestedShapes(shapes, owner=None, image=image)
         annotateNestedShapes(shapes, owner=None, image=whiteImg)
 
-    return (shapes, approximatedContours, image, whiteImg)
+    # Rasterise the shape hierarchy if desired, at the resolution of the image
+    # passed.
+    shapeLabels = LabelMap(shapes, image.shape) if labelMap else None
+
+    return (shapes, approximatedContours, image, whiteImg, shapeLabels)
 
 def annotateShapeTypes(shapes, image):
     # Annotate shape type at midpoint of the shape.
@@ -189,7 +180,7 @@ if (__name__ == "__main__"):
     whiteImg = np.zeros((image.shape[0],image.shape[1],3)) + 255
 
     # Find containers
-    shapes, approximatedContours, image, whiteImg = getContainers(image)
+    shapes, approximatedContours, image, _, _ = getContainers(image)
 
     # shapes = [shape for shape in shapes if shape.area != 0]
 
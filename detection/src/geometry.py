@@ -4,6 +4,7 @@
 import numpy as np
 import cv2
 import math
+from collections import defaultdict
 
 _DEBUG = False
 
@@ -14,39 +15,51 @@ _DEBUG = False
 # Method by PyImageSearch:
 # https://www.pyimagesearch.com/2016/11/07/intersection-over-union-iou-for-object-detection/
 def calc_iou(boxVerts, otherBoxVerts, debug=False):
-    _DEBUG = debug
     (bx1, by1), _, (bx3, by3), _ = boxVerts
     (ox1, oy1), _, (ox3, oy3), _ = otherBoxVerts
 
     i1 = [max(bx1, ox1), max(by1, oy1)]
     i3 = [min(bx3, ox3), min(by3, oy3)]
 
-    log("Box: "+ str(boxVerts))
-    log("OtherBox: " + str(otherBoxVerts))
-
-    intersection_vertices = [i1, [i1[0], i3[1]], i3, [i3[0], i1[1]]]
-
-    log("Intersection: " + str(intersection_vertices))
     intersection_area = max((i3[1] - i1[1]) + 1, 0) * max((i3[0] - i1[0]) + 1, 0)
 
-
-    log("intersection area: " + str(intersection_area))
     box_area = (by3 - by1) * (bx3 - bx1)
 
-    log("box area: " + str(box_area))
     otherBox_area = (oy3 - oy1) * (ox3 - ox1)
 
-    log("other box area: " + str(otherBox_area))
-
     iou = float(intersection_area) / (float(box_area) + float(otherBox_area) -  float(intersection_area))
 
+    # Messages are only built when debugging, as this is called for many pairs
+    # of boxes.
+    if (debug):
+        print("GEOMETRY | Box: " + str(boxVerts) + ", OtherBox: " + str(otherBoxVerts))
+        print("GEOMETRY | intersection area: " + str(intersection_area) + ", box area: " + str(box_area) + ", other box area: " + str(otherBox_area))
+        print("GEOMETRY | IOU : " + str(iou))
 
-    log("IOU : "+ str(iou))
     # Return IOU. We remove the intersection_area from the added box areas so that
     # we dont count the intersection area twice. (Since we are interested in
     # the union of the two areas).
     return iou
 
+# Calculates the IOU score, as in calc_iou, between every box in 'boxes' and
+# every box in 'otherBoxes', both given as (n, 4) arrays of (x0, y0, x1, y1).
+# Returns an (n, m) matrix. Rows of NaN (boxes which are not rectangles) give
+# NaN scores, which never pass a threshold.
+def calc_iou_matrix(boxes, otherBoxes):
+    boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+    otherBoxes = np.asarray(otherBoxes, dtype=float).reshape(-1, 4)
+
+    bx1, by1, bx3, by3 = [ boxes[:, [i]] for i in range(0, 4) ]
+    ox1, oy1, ox3, oy3 = [ otherBoxes[:, i] for i in range(0, 4) ]
+
+    intersection_area = np.maximum(np.minimum(by3, oy3) - np.maximum(by1, oy1) + 1, 0) * \
+        np.maximum(np.minimum(bx3, ox3) - np.maximum(bx1, ox1) + 1, 0)
+
+    union_area = (by3 - by1) * (bx3 - bx1) + (oy3 - oy1) * (ox3 - ox1) - intersection_area
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return intersection_area / union_area
+
 def getBoundingBox(vertices):
     (x, y, w, h) = cv2.boundingRect(vertices)
     return np.array([[x, y], [x, y+h], [x+w, y+h], [x+w, y]]).reshape(-1,2)
@@ -117,6 +130,99 @@ def pointWithinPlane(line, p):
 
     return np.dot([p[0], p[1], 1], eqn) < 0
 
+# Returns the (x0, y0, x1, y1) extent of a list of vertices if they describe an
+# axis-aligned rectangle in the vertex order produced by getBoundingBox, or None
+# otherwise.
+def getAxisAlignedBox(vertices):
+    if (len(vertices) != 4): return None
+    (x0, y0), (ax, y1), (x1, ay), (bx, by) = [ (v[0], v[1]) for v in vertices ]
+    if (ax != x0 or ay != y1 or bx != x1 or by != y0): return None
+    if (x1 <= x0 or y1 <= y0): return None
+    return (x0, y0, x1, y1)
+
+# Static index over axis-aligned boxes given as (x0, y0, x1, y1). Boxes are
+# sorted by their left edge, so a containment query binary searches for the
+# boxes starting to the left of the query box and filters only those, with
+# NumPy, instead of testing every box.
+class BoxIndex:
+
+    def __init__(self, boxes):
+        self.boxes = np.array(boxes, dtype=float).reshape(-1, 4)
+        self.order = np.argsort(self.boxes[:, 0], kind='stable')
+        self.sortedX0 = self.boxes[self.order, 0]
+
+    # Returns the indices of the boxes which strictly contain the box passed, in
+    # the same sense as Shape.contains for rectangles.
+    def containing(self, box):
+        x0, y0, x1, y1 = box
+        candidates = self.order[:np.searchsorted(self.sortedX0, x0, side='left')]
+        boxes = self.boxes[candidates]
+        return candidates[(boxes[:, 2] > x1) & (boxes[:, 1] < y0) & (boxes[:, 3] > y1)]
+
+# Vectorised form of pointWithinPlane, testing an (n, 2) array of points against
+# a single line at once. Returns a boolean array.
+def pointsWithinPlane(line, points):
+
+    startPoint, endPoint = line
+    xs, ys = points[:, 0], points[:, 1]
+
+    if (startPoint[0] == endPoint[0]):
+        if (startPoint[1] < endPoint[1]): return xs > startPoint[0]
+        else: return xs < startPoint[0]
+
+    if (startPoint[1] == endPoint[1]):
+        if (startPoint[0] < endPoint[0]): return ys < startPoint[1]
+        else: return ys > startPoint[1]
+
+    a, b, c = calulateImplicitLineEquation(line)
+    return (a * xs) + (b * ys) + c < 0
+
+# Tests an (n, 2) array of points against the polygon described by 'vertices'
+# using half-plane insideness, returning a boolean array. Equivalent to calling
+# pointWithinPlane for every edge and point, with a fast path for axis-aligned
+# rectangles (which all shape vertices currently are).
+def pointsWithinPolygon(vertices, points):
+
+    points = np.asarray(points).reshape(-1, 2)
+
+    box = getAxisAlignedBox(vertices)
+    if (box is not None):
+        x0, y0, x1, y1 = box
+        return (points[:, 0] > x0) & (points[:, 0] < x1) & (points[:, 1] > y0) & (points[:, 1] < y1)
+
+    inside = np.ones(len(points), dtype=bool)
+    for edge in getEdges(vertices):
+        inside &= pointsWithinPlane(edge, points)
+    return inside
+
+# Uniform grid hash over a fixed set of 2D points, used to find the points lying
+# within some radius of a query point by only examining nearby grid cells rather
+# than every point.
+class PointGrid:
+
+    def __init__(self, points, cellSize):
+        self.points = np.array(points, dtype=float).reshape(-1, 2)
+        self.cellSize = float(cellSize)
+        self.cells = defaultdict(list)
+        for i, cell in enumerate(np.floor(self.points / self.cellSize).astype(int).tolist()):
+            self.cells[tuple(cell)].append(i)
+
+    # Returns the indices of the points within 'radius' (inclusive) of the point
+    # passed, along with their distances from it.
+    def query(self, point, radius):
+        reach = int(math.ceil(radius / self.cellSize))
+        cx, cy = int(math.floor(point[0] / self.cellSize)), int(math.floor(point[1] / self.cellSize))
+
+        indices = []
+        for x in range(cx - reach, cx + reach + 1):
+            for y in range(cy - reach, cy + reach + 1):
+                indices.extend(self.cells.get((x, y), []))
+
+        indices = np.array(indices, dtype=int)
+        distances = np.sqrt(((self.points[indices] - np.asarray(point, dtype=float)) ** 2).sum(axis=1)) if len(indices) > 0 else np.zeros(0)
+        within = distances <= radius
+        return indices[within], distances[within]
+
 def euclideanDistance(point1, point2):
     dist = math.sqrt( (point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2 )
     # print("Distance between " + str(point1) + ", and " + str(point2) + ": " + str(dist))
@@ -133,35 +239,48 @@ def straightenAlongAxis(xs, threshold):
     return straighten(output, threshold)
 
 def straighten(xs, threshold):
-    print("Straightening with threshold: "+ str(threshold))
-    straightened = False
-    for x in xs:
-        skewedXs = getSimilarValuesWithinRange(xs, x, threshold)
-        # print("SkewedAxisVals: " + str(skewedXs))
-        # print("Xs: " + str(xs))
-        # print("Replaceing : " + str(skewedXs[:,0]) + " with: " + str(round(np.mean(skewedXs[:,0]))))
-        if (len(np.unique(skewedXs) > 1)): straightened = False
-        # Average out the coordinate values.
-        skewedXs[:,0] = round(np.mean(skewedXs[:,0]))
-
-
-        # Replace all coordinate values in 'xs' array with the new
-        # averaged values at the index positions where they originally
-        # occurred.
-        xs[skewedXs[:,1]] = skewedXs[:,0]
-        # print("Xs[After]: " + str(xs))
-    return straighten(xs,threshold) if straightened else xs
+    xs[:] = snapValues(xs, threshold)
+    return xs
+
+# Snaps together values lying within 'threshold' of each other. Values are
+# sorted and swept once, starting a new group wherever a value lies more than
+# the threshold beyond the first value of the current group, so a group never
+# spans more than the threshold; every value in a group is replaced by the
+# group's rounded mean. Returns a new array in the original order.
+def snapValues(values, threshold):
+    values = np.asarray(values)
+    if (len(values) == 0): return values.copy()
+
+    order = np.argsort(values, kind='stable')
+    sortedValues = values[order].astype(float)
+
+    # Label each sorted value with the index of the group it belongs to. Each
+    # group ends at the last value within the threshold of its first value.
+    groups = np.empty(len(sortedValues), dtype=int)
+    start, group = 0, 0
+    while (start < len(sortedValues)):
+        end = np.searchsorted(sortedValues, sortedValues[start] + threshold, side='right')
+        groups[start:end] = group
+        start, group = end, group + 1
+
+    means = np.bincount(groups, weights=sortedValues) / np.bincount(groups)
+
+    snapped = np.empty(len(values), dtype=float)
+    snapped[order] = np.round(means)[groups]
+    return snapped.astype(values.dtype) if np.issubdtype(values.dtype, np.integer) else snapped
+
+# Snaps the x and y coordinates of an (n, 2) array of vertices independently, so
+# that nearly aligned edges become exactly horizontal or vertical.
+def snapVertices(vertices, threshold):
+    vertices = np.asarray(vertices).reshape(-1, 2)
+    return np.stack([ snapValues(vertices[:, 0], threshold), snapValues(vertices[:, 1], threshold) ], axis=1)
 
 # Given an array, returns a 2d array containing the element and the index position
 # at which it occurs.
 def getSimilarValuesWithinRange(array, element, threshold):
-    output = []
-    for i in range(0, len(array)):
-        item = array[i]
-        if (abs(item - element) <= threshold):
-            output.append([item, i])
-    # print("Similar Values: " + str(output))
-    return np.array(output)
+    array = np.asarray(array)
+    indices = np.flatnonzero(np.abs(array - element) <= threshold)
+    return np.stack([ array[indices], indices ], axis=1) if len(indices) > 0 else np.zeros((0, 2))
 
 def calculateMidpoint(vertices):
     return [int(round(np.mean(vertices[:,0]))), int(round(np.mean(vertices[:,1])))]
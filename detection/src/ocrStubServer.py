@@ -0,0 +1,60 @@
+# Local stand-in for the Cloud Vision API, used to develop and benchmark the
+# detection pipeline without network access. Serves text detections from a
+# fixture file (see textDetect.FixtureBackend) over HTTP, for use with
+# OCR_BACKEND=http.
+#
+# POST /ocr with the raw image bytes as the body returns a JSON list of
+# [word, confidence, bounding_rect] entries.
+#
+# With --key, prints the fixture key of each image file passed instead, for
+# use when writing fixture files.
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from textDetect import FixtureBackend, getFixtureKey
+import argparse
+import json
+import sys
+
+def log(msg):
+    print("OCR STUB SERVER | " + msg)
+
+def createHandler(backend):
+
+    class OCRStubHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if (self.path != '/ocr'):
+                self.send_error(404)
+                return
+
+            imageBytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            body = json.dumps(backend.detect(imageBytes)).encode('utf8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return OCRStubHandler
+
+if (__name__ == "__main__"):
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-f", "--fixtures", required=False, help="Path to the JSON fixture file.")
+    ap.add_argument("-p", "--port", required=False, type=int, default=5374)
+    ap.add_argument("-l", "--latency", required=False, type=float, default=0, help="Simulated latency per request, in seconds.")
+    ap.add_argument("-k", "--key", required=False, nargs='+', metavar="IMAGE", help="Print the fixture key of each image and exit.")
+    args = vars(ap.parse_args())
+
+    if (args['key'] is not None):
+        for imagePath in args['key']:
+            print(getFixtureKey(imagePath) + "  " + imagePath)
+        sys.exit(0)
+
+    backend = FixtureBackend(args['fixtures'], latency=args['latency'])
+
+    log("Running on port " + str(args['port']))
+    HTTPServer(('0.0.0.0', args['port']), createHandler(backend)).serve_forever()
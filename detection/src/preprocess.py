@@ -0,0 +1,41 @@
+# This module holds the binarisation shared by the contour based detectors, so
+# that the grayscale conversion, Otsu threshold and inversion are computed once
+# per image rather than once per detector.
+
+import cv2
+
+# The preprocessed intermediates for a single image. The binarised images are
+# computed up front, since every detector needs them; the blurred image is only
+# used by line detection and so is computed on first use.
+class Preprocessed:
+
+    __slots__ = ['image', 'gray', 'thresh', 'invert', '_blurred']
+
+    def __init__(self, image):
+        self.image = image
+
+        # Convert the image to grayscale.
+        self.gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+        # Using otsu's binarisation.
+        # This works by analysing the image histogram, a distribution of the particular
+        # tones in an image. Each bar represents the frequency of pixels corresponding
+        # to that particular tone.
+        ret, self.thresh = cv2.threshold(self.gray, 0, 255, cv2.THRESH_BINARY+cv2.THRESH_OTSU)
+
+        # Invert the image so that our desired shapes are highlighted in white.
+        self.invert = cv2.bitwise_not(self.thresh)
+
+        self._blurred = None
+
+    # The inverted image blurred with a gaussian kernel.
+    @property
+    def blurred(self):
+        if (self._blurred is None): self._blurred = cv2.GaussianBlur(self.invert, (5,5), 0)
+        return self._blurred
+
+# Returns the preprocessed intermediates for the image passed. If intermediates
+# were already computed for the image (or a copy of it) they are reused.
+def preprocess(image, preprocessed=None):
+    if (preprocessed is not None): return preprocessed
+    return Preprocessed(image)
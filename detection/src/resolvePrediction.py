@@ -10,7 +10,12 @@
 # @ Aaron Baw 2018
 
 from shape import Shape
+from shapeHierarchy import FlattenedHierarchy
+from geometry import calc_iou_matrix
+from scipy.optimize import linear_sum_assignment
 import numpy as np
+import time
+import sys
 import os
 
 # Shapes with an IOU score greater than the below will be resolved into a single
@@ -19,55 +24,180 @@ _IOU_THRESHOLD = 0.5
 _TEXT_CONFIDENCE_THRESHOLD = 0.65
 _DEBUG = True if os.getenv('PY_DEBUG') is not None else False
 
-def addNewShape(shapes, newShape):
-    log("No intersecting shapes for " + str(newShape) + ". Creating one now.")
-    for shape in shapes:
+# How predicted primitives are assigned to shapes. 'greedy' merges each
+# primitive, in order, into the shape it overlaps most, so several primitives
+# may merge into the same shape. 'hungarian' assigns primitives to shapes one to
+# one so that the total IOU is maximised.
+_ASSIGNMENT_MODE = os.getenv('RESOLVE_ASSIGNMENT', 'greedy')
+
+# Hungarian assignment is cubic in the number of candidates, so it falls back to
+# greedy assignment when the candidate IOU matrix has more cells than this.
+_ASSIGNMENT_MAX_CELLS = int(os.getenv('RESOLVE_ASSIGNMENT_MAX_CELLS', 250000))
+
+# Nests newShape within the first top level shape containing it, or adds it to
+# the top level otherwise. 'containers' may be passed to narrow down which of the
+# top level shapes (in order) could contain it.
+def addNewShape(shapes, newShape, containers=None):
+    log("No intersecting shapes for", newShape, ". Creating one now.")
+    for shape in (shapes if containers is None else containers):
         if shape.contains(newShape):
             shape.nest(newShape)
             return
 
     # If no shapes contain the predicted primitive, add it to the highest
     # level.
-    log("No shapes contain newShape " + str(newShape) + ". Adding it to the highest level.")
+    log("No shapes contain newShape", newShape, ". Adding it to the highest level.")
     shapes.append(newShape)
 
-# Returns a list of shapes and their ious which intersect with the primitive.
-# Shape IDs are also returned in case the objects added to the array are not
-# references to the objects in the shape array.
-def getIntersectingShapes(primitive, shapes, iou_threshold):
-
-    # log("Detecting intersections for " + str(primitive))
-
-    intersecting_shapes = []
-
-    if shapes is None or len(shapes) == 0: return intersecting_shapes
-
-    for shape in shapes:
-
-        # log("Examining intersection between primitive "+str(primitive.type) + " and shape " + str(shape))
-
-        intersecting_shapes_contained_within_shape = getIntersectingShapes(primitive, shape.contained, iou_threshold)
-
-        # log("Currenet intersecting shapes: "+ str(intersecting_shapes))
-        # log("Intersecting shapes contained within " +str(shape) + ": " + str(intersecting_shapes_contained_within_shape))
-
-
-        # Call recursively on children of the current shape.
-        intersecting_shapes = intersecting_shapes + intersecting_shapes_contained_within_shape
-
-        # intersecting_shapes = np.concatenate([intersecting_shapes, intersecting_shapes_contained_within_shape]).tolist()
-
-        iou_val = shape.calc_iou(primitive)
-        if iou_val >= iou_threshold:
-            intersecting_shapes.append((shape, iou_val))
+# Returns an (n, 4) array of the (x0, y0, x1, y1) bounding boxes of the shapes
+# passed. Shapes without a rectangular bounding box get a row of NaN, so they
+# never match.
+def getShapeBoxes(shapes):
+    boxes = np.full((len(shapes), 4), np.nan)
+    for row, shape in enumerate(shapes):
+        if (len(shape.boundingBox) != 4): continue
+        (x0, y0), _, (x1, y1), _ = shape.boundingBox
+        boxes[row] = (x0, y0, x1, y1)
+    return boxes
+
+# Returns an (n, 4) array of the (x0, y0, x1, y1) extent of the vertices of the
+# shapes passed. Points and lines, which never contain other shapes, get a row
+# of NaN.
+def getVertexExtents(shapes):
+    extents = np.full((len(shapes), 4), np.nan)
+    for row, shape in enumerate(shapes):
+        if (len(shape.vertices) <= 2): continue
+        vertices = np.asarray(shape.vertices).reshape(-1, 2)
+        extents[row] = (*vertices.min(axis=0), *vertices.max(axis=0))
+    return extents
+
+# Returns a mask selecting the extents which strictly contain the extent passed.
+# A shape can only contain another if this holds for their vertices, so the mask
+# narrows down which shapes need to be tested with Shape.contains.
+def getContainingMask(extents, extent):
+    x0, y0, x1, y1 = extent
+    return (extents[:, 0] < x0) & (extents[:, 1] < y0) & (extents[:, 2] > x1) & (extents[:, 3] > y1)
+
+# Returns a mask over the rows of a flattened hierarchy (given by the parent row
+# of each row) selecting every descendant of the row passed.
+def getDescendantMask(parents, row):
+    mask = np.zeros(len(parents), dtype=bool)
+    frontier = parents == row
+    while frontier.any():
+        mask |= frontier
+        frontier = np.isin(parents, np.flatnonzero(frontier)) & ~mask
+    return mask
+
+# Returns, for each prediction (row of 'ious'), the column of the shape it is
+# assigned to by Hungarian matching, or -1 if it is unassigned. Only pairs with
+# an IOU of at least iou_threshold may be assigned. Returns None if there are
+# more than maxCells candidate pairs.
+def getOptimalAssignment(ious, iou_threshold, maxCells=_ASSIGNMENT_MAX_CELLS):
+
+    start = time.perf_counter()
+
+    assignment = np.full(len(ious), -1)
+
+    # Only predictions and shapes with at least one eligible pair take part.
+    eligible = np.nan_to_num(ious) >= iou_threshold
+    predictionRows = np.flatnonzero(eligible.any(axis=1))
+    shapeColumns = np.flatnonzero(eligible.any(axis=0))
+
+    if (len(predictionRows) * len(shapeColumns) > maxCells):
+        report("Optimal assignment of " + str(len(predictionRows)) + "x" + str(len(shapeColumns)) + " candidates exceeds " + str(maxCells) + " cells; falling back to greedy assignment.")
+        return None
+
+    candidates = np.ix_(predictionRows, shapeColumns)
+    weights = np.where(eligible[candidates], ious[candidates], 0)
+
+    # Minimise the negated IOU, i.e. maximise the total IOU.
+    assignedRows, assignedColumns = linear_sum_assignment(-weights)
+    assigned = eligible[candidates][assignedRows, assignedColumns]
+    assignment[predictionRows[assignedRows[assigned]]] = shapeColumns[assignedColumns[assigned]]
+
+    log("Optimal assignment of " + str(len(predictionRows)) + "x" + str(len(shapeColumns)) + " candidates took " + str(round((time.perf_counter() - start) * 1000, 2)) + "ms.")
+
+    return assignment
+
+# Resolves each predicted shape, in order, against the shape hierarchy: the
+# prediction is merged into the shape it overlaps most, if the IOU is at least
+# iou_threshold, and is otherwise added as a new shape.
+#
+# The IOU of every prediction against every shape, and against every other
+# prediction (for predictions added as new shapes), is computed once as a single
+# matrix. Columns are masked out as shapes are detached from the hierarchy (a
+# merged shape drops its contents) and enabled as predictions are added to it,
+# so the result matches resolving the predictions one at a time.
+#
+# With 'hungarian' assignment, each prediction is only merged into the shape it
+# was assigned to up front. Predictions left unassigned although they overlap a
+# shape are duplicates of an assigned prediction and are dropped; the rest are
+# added as new shapes.
+def resolvePredictedShapes(predictedShapes, shapes, iou_threshold, assignment='greedy'):
+
+    if (len(predictedShapes) == 0): return shapes
+
+    hierarchy = FlattenedHierarchy.fromShapes(shapes)
+    rows = hierarchy.shapes + predictedShapes
+    shapeCount = len(hierarchy)
+
+    predictedBoxes = getShapeBoxes(predictedShapes)
+    ious = calc_iou_matrix(predictedBoxes, np.concatenate([ getShapeBoxes(hierarchy.shapes), predictedBoxes ]))
+
+    # Rows for predictions only become active once they are added as shapes.
+    active = np.zeros(len(rows), dtype=bool)
+    active[:shapeCount] = True
+    parents = np.concatenate([ hierarchy.parents, np.full(len(predictedShapes), -1, dtype=np.int32) ])
+
+    # Vertex extents, used to find the shapes which could contain a new shape.
+    extents = getVertexExtents(rows)
+
+    assigned = getOptimalAssignment(ious[:, :shapeCount], iou_threshold) if assignment == 'hungarian' else None
+
+    for i, predictedShape in enumerate(predictedShapes):
+
+        if (assigned is None):
+            candidates = np.flatnonzero(active & (ious[i] >= iou_threshold))
+        elif (assigned[i] == -1 and np.any(ious[i, :shapeCount] >= iou_threshold)):
+            log("Dropping", predictedShape, "as its shapes were assigned to other predictions.")
+            continue
+        else:
+            candidates = np.flatnonzero(active[:shapeCount] & (np.arange(shapeCount) == assigned[i]))
+
+        if (len(candidates) == 0):
+            row = shapeCount + i
+            containing = active & getContainingMask(extents, extents[row])
+
+            # Top level rows are in the same order as the top level shapes.
+            addNewShape(shapes, predictedShape, [ rows[top] for top in np.flatnonzero(containing & (parents == -1)) ])
+            active[row] = True
+
+            # Record where the shape was nested, so that it is detached along
+            # with its container.
+            if (predictedShape.parentId is not None):
+                parents[row] = next(
+                    parent for parent in np.flatnonzero(containing)
+                    if len(rows[parent].contained) > 0 and rows[parent].contained[-1] is predictedShape
+                )
+            continue
+
+        # Assign the shape with the largest overlap the classification from
+        # the predicted primitive.
+        best = candidates[np.argmax(ious[i, candidates])]
+        mergeShapeWithPrimitive(predictedShape, rows[best], ious[i, best])
+
+        # The merged shape drops its contents and takes its bounding box as
+        # its vertices.
+        active &= ~getDescendantMask(parents, best)
+        extents[best] = getVertexExtents([ rows[best] ])[0]
 
-    return intersecting_shapes
+    return shapes
 
 def mergeShapeWithPrimitive(primitiveShape, intersectingShape, iou):
 
     intersectingShape.type = primitiveShape.type
 
-    log("Classifying "+str(intersectingShape) + " as " + str(primitiveShape.type))
+    log("Classifying", intersectingShape, "as", primitiveShape.type)
 
     # Set the vertices of the intersectingshape to its bounding box.
     intersectingShape.vertices = intersectingShape.boundingBox
@@ -99,22 +229,14 @@ def resolveTextUsingPredictions(textPredictions, shapes, lastShapeId):
     # Skip the first prediction, as this returns a bounding box over all
     # text detected in the image, instead of the components, which we are looking
     # for. This will cause panels and containers to be resolved as text.
-    for text, confidence, bounding_rect in textPredictions:
-        log("Resolving text:" + str(text))
-        predicted_bounding_rect = Shape(bounding_rect, id=lastShapeId, shapeType="header", content=text)
-        lastShapeId = lastShapeId + 1
-        intersecting_shapes = getIntersectingShapes(predicted_bounding_rect, shapes, _IOU_THRESHOLD - 0.2)
-        log("Intersecting shapes for " + str(text)+ ": " + str(intersecting_shapes))
-        # Sort intersecting shapes by largest intersections.
-        intersecting_shapes = np.array(intersecting_shapes, dtype=[('shape', Shape), ('iou', float)])
-        intersecting_shapes.sort(order='iou')
-        if (len(intersecting_shapes) >= 1):
-            intersecting_shape, iou = intersecting_shapes[-1]
-            mergeShapeWithPrimitive(predicted_bounding_rect, intersecting_shape, iou)
-        elif (intersecting_shapes is None or len(intersecting_shapes) == 0):
-            addNewShape(shapes, predicted_bounding_rect)
+    predictedShapes = [
+        Shape(bounding_rect, id=lastShapeId + i, shapeType="header", content=text)
+        for i, (text, confidence, bounding_rect) in enumerate(textPredictions)
+    ]
 
-    return shapes
+    log("Resolving", len(predictedShapes), "text predictions.")
+
+    return resolvePredictedShapes(predictedShapes, shapes, _IOU_THRESHOLD - 0.2)
 
 def resolveShapesUsingPredictions(primitives, shapes, lastShapeId):
 
@@ -122,30 +244,21 @@ def resolveShapesUsingPredictions(primitives, shapes, lastShapeId):
     # shape we detected. We do this by computing the overlap between the two
     # bounding boxes, and assigning the primitive classification where there
     # is a high degree of intersection.
-    for primitive in primitives:
-        box, vertices, label, id, confidence = primitive
-        log("Resolving predicted primitive: " + str(label))
-        predictedShape = Shape(vertices, id=lastShapeId, shapeType=label)
-        lastShapeId = lastShapeId + 1
-
-        intersecting_shapes = getIntersectingShapes(predictedShape, shapes, _IOU_THRESHOLD)
-
-        # Sort intersecting shapes by largest intersections.
-        intersecting_shapes = np.array(intersecting_shapes, dtype=[('shape', Shape), ('iou', float)])
-        intersecting_shapes.sort(order='iou')
-
-        log("Intersecting shapes: " + str(intersecting_shapes))
-
-        if (intersecting_shapes is None or len(intersecting_shapes) == 0):
-            addNewShape(shapes, predictedShape)
-        elif (len(intersecting_shapes) >= 1):
+    predictedShapes = [
+        Shape(vertices, id=lastShapeId + i, shapeType=label)
+        for i, (box, vertices, label, id, confidence) in enumerate(primitives)
+    ]
 
-            # Assign the shape with the largest overlap the classification from
-            # the predicted primitive.
-            intersecting_shape, iou_val = intersecting_shapes[-1]
-            mergeShapeWithPrimitive(predictedShape, intersecting_shape, iou_val)
+    log("Resolving", len(predictedShapes), "predicted primitives.")
 
-    return shapes
+    return resolvePredictedShapes(predictedShapes, shapes, _IOU_THRESHOLD, _ASSIGNMENT_MODE)
 
 def log(*msg):
     if (_DEBUG): print("PRIMITIVE DETECT | ", msg)
+
+# Reports warnings outside debug mode, on stderr, so as not to interfere with
+# the results written to stdout in worker mode. In debug mode they are logged
+# along with everything else.
+def report(message):
+    if (_DEBUG): log(message)
+    else: print("PRIMITIVE DETECT | " + message, file=sys.stderr)
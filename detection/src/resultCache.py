@@ -0,0 +1,158 @@
+# Content-addressed cache for detection results. Results are keyed by a digest
+# of the image bytes together with the pipeline configuration, so re-submitting
+# the same wireframe returns the previously serialised hierarchy without running
+# OpenCV, YOLO or OCR again.
+#
+# Entries are held in a bounded in-memory LRU and, optionally, written to a
+# directory on disk so that they survive restarts and can be shared between
+# worker processes. The directory is bounded too: the number of entries is
+# tracked as they are written, and once it exceeds 'maxDiskSize' the directory
+# is pruned, deleting the oldest entries (by modification time) until it holds
+# a fraction of 'maxDiskSize', so that the directory is not listed on every
+# write. Entries may also be given a time-to-live, after which they are treated
+# as misses (and deleted from disk when pruning).
+
+from collections import OrderedDict
+import hashlib
+import threading
+import json
+import time
+import os
+
+_DEFAULT_MAX_SIZE = 128
+_DEFAULT_MAX_DISK_SIZE = 4096
+
+# Fraction of maxDiskSize to which the directory is pruned once it is full.
+_PRUNE_TO_FRACTION = 0.9
+
+def log(msg):
+    if os.getenv('PY_DEBUG') is not None:
+        print("RESULT CACHE | " + str(msg))
+
+# Returns the cache key for the encoded image bytes and pipeline config passed.
+def computeKey(imageBytes, config):
+    digest = hashlib.sha256(imageBytes)
+    digest.update(json.dumps(config, sort_keys=True).encode('utf8'))
+    return digest.hexdigest()
+
+class ResultCache:
+
+    def __init__(self, maxSize=_DEFAULT_MAX_SIZE, directory=None, ttl=None, maxDiskSize=_DEFAULT_MAX_DISK_SIZE):
+        self.maxSize = maxSize
+        self.maxDiskSize = maxDiskSize
+        self.directory = directory
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        # Estimated number of entries in the directory. Other processes sharing
+        # the directory also write to it, so this is recounted when pruning.
+        self.diskSize = 0
+
+        if (self.directory is not None):
+            if (not os.path.exists(self.directory)): os.makedirs(self.directory)
+            self.diskSize = len(self.listDirectory())
+
+    def isExpired(self, storedAt):
+        return self.ttl is not None and time.time() - storedAt > self.ttl
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    # Returns the cached result for the key, or None if there isn't one. A fresh
+    # copy is returned each time so callers may mutate it.
+    def get(self, key):
+        serialised = None
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None):
+                storedAt, serialised = entry
+                if (self.isExpired(storedAt)):
+                    del self.entries[key]
+                    serialised = None
+                else: self.entries.move_to_end(key)
+
+        if (serialised is None and self.directory is not None):
+            # The entry may be deleted by another process at any point, in
+            # which case it is treated as a miss.
+            try:
+                storedAt = os.path.getmtime(self.getPath(key))
+                if (not self.isExpired(storedAt)):
+                    with open(self.getPath(key), 'r') as file:
+                        serialised = file.read()
+                    self.putSerialised(key, serialised, storedAt)
+            except OSError:
+                serialised = None
+
+        with self.lock:
+            if (serialised is None): self.misses += 1
+            else: self.hits += 1
+
+        log(("Hit " if serialised is not None else "Miss ") + key)
+
+        return json.loads(serialised) if serialised is not None else None
+
+    def put(self, key, result):
+        serialised = json.dumps(result)
+        self.putSerialised(key, serialised)
+
+        if (self.directory is not None):
+            # Write to a temporary file first so that readers never see a
+            # partially written entry.
+            tempPath = self.getPath(key) + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+            isNew = not os.path.exists(self.getPath(key))
+            with open(tempPath, 'w') as file:
+                file.write(serialised)
+            os.replace(tempPath, self.getPath(key))
+
+            with self.lock:
+                if (isNew): self.diskSize += 1
+                full = self.diskSize > self.maxDiskSize
+            if (full): self.prune()
+
+    # Returns the (modification time, path) of each entry in the directory.
+    # Entries deleted by another process while listing are skipped.
+    def listDirectory(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if (not name.endswith('.json')): continue
+            path = os.path.join(self.directory, name)
+            try: entries.append((os.path.getmtime(path), path))
+            except FileNotFoundError: continue
+        return entries
+
+    # Deletes expired entries from the directory, and then the oldest entries
+    # until it holds at most _PRUNE_TO_FRACTION of maxDiskSize. Other processes
+    # sharing the directory may be pruning at the same time, so entries which
+    # have already been deleted are skipped.
+    def prune(self):
+        entries = sorted(self.listDirectory())
+        excess = max(len(entries) - int(self.maxDiskSize * _PRUNE_TO_FRACTION), 0)
+        removed = 0
+        for i, (storedAt, path) in enumerate(entries):
+            if (i >= excess and not self.isExpired(storedAt)): break
+            removed += 1
+            try: os.remove(path)
+            except FileNotFoundError: continue
+            log("Pruned " + path)
+
+        with self.lock:
+            self.diskSize = len(entries) - removed
+
+    def putSerialised(self, key, serialised, storedAt=None):
+        with self.lock:
+            self.entries[key] = (storedAt if storedAt is not None else time.time(), serialised)
+            self.entries.move_to_end(key)
+            while (len(self.entries) > self.maxSize):
+                self.entries.popitem(last=False)
+
+# Creates a cache configured through DETECT_CACHE_SIZE, DETECT_CACHE_DIR and
+# DETECT_CACHE_DISK_SIZE. Returns None if DETECT_CACHE_SIZE is 0, disabling
+# caching.
+def createFromEnv():
+    maxSize = int(os.getenv('DETECT_CACHE_SIZE', _DEFAULT_MAX_SIZE))
+    if (maxSize <= 0): return None
+    maxDiskSize = int(os.getenv('DETECT_CACHE_DISK_SIZE', _DEFAULT_MAX_DISK_SIZE))
+    return ResultCache(maxSize, directory=os.getenv('DETECT_CACHE_DIR'), maxDiskSize=maxDiskSize)
@@ -0,0 +1,149 @@
+# Finds the points at which line segments (e.g. those returned by HoughLinesP)
+# intersect.
+#
+# Segments are bucketed into a uniform grid by their bounding boxes, and only
+# segments sharing a grid cell are tested against each other, all candidate
+# pairs at once with NumPy. Like the Bentley Ottmann implementation previously
+# used (isect_segments-bentley_ottmann), parallel and collinear segments are not
+# reported as intersecting, nor are segments which only touch at an endpoint
+# they share, and each intersection point is reported once.
+
+import numpy as np
+import argparse
+import time
+
+# Tolerance used when testing whether an intersection lies on a segment, or at
+# one of its endpoints.
+_EPSILON = 1e-9
+
+# Decimal places to which intersection points are rounded before removing
+# duplicates, as the same point is found with slightly different rounding error
+# from each pair of segments crossing there.
+_POINT_PRECISION = 6
+
+# Returns the unique intersection points of the segments passed, given as
+# ((x1, y1), (x2, y2)) pairs or as an (n, 4) array, as a list of (x, y) tuples
+# sorted by x and then y. 'cellSize' is the side length of the grid cells used
+# to bucket segments, and defaults to the average segment extent.
+def findSegmentIntersections(segments, cellSize=None):
+
+    segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+
+    if (len(segments) < 2): return []
+
+    first, second = getCandidatePairs(segments, cellSize)
+
+    return intersectPairs(segments, first, second)
+
+# Returns the pairs of segments, as two index arrays (with first < second),
+# whose bounding boxes share at least one grid cell.
+def getCandidatePairs(segments, cellSize=None):
+
+    x0 = np.minimum(segments[:, 0], segments[:, 2])
+    y0 = np.minimum(segments[:, 1], segments[:, 3])
+    x1 = np.maximum(segments[:, 0], segments[:, 2])
+    y1 = np.maximum(segments[:, 1], segments[:, 3])
+
+    if (cellSize is None): cellSize = max(np.mean(np.maximum(x1 - x0, y1 - y0)), 1.0)
+
+    originX, originY = x0.min(), y0.min()
+    cx0 = ((x0 - originX) // cellSize).astype(np.int64)
+    cy0 = ((y0 - originY) // cellSize).astype(np.int64)
+    cx1 = ((x1 - originX) // cellSize).astype(np.int64)
+    cy1 = ((y1 - originY) // cellSize).astype(np.int64)
+
+    # Enumerate every (segment, cell) pair covered by each segment's bounding box.
+    columns = cx1 - cx0 + 1
+    counts = columns * (cy1 - cy0 + 1)
+    owners = np.repeat(np.arange(len(segments)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    cellXs = cx0[owners] + offsets % columns[owners]
+    cellYs = cy0[owners] + offsets // columns[owners]
+    cells = cellXs * (cy1.max() + 1) + cellYs
+
+    # Sort entries by cell, so each cell's segments are contiguous. Pairs within
+    # a cell are then found by comparing each entry with the entries 1, 2, ...
+    # places after it, up to the size of the fullest cell.
+    order = np.lexsort((owners, cells))
+    cells, owners = cells[order], owners[order]
+
+    pairs = []
+    for distance in range(1, len(cells)):
+        sameCell = cells[:-distance] == cells[distance:]
+        if (not sameCell.any()): break
+        pairs.append(np.stack([ owners[:-distance][sameCell], owners[distance:][sameCell] ], axis=1))
+
+    if (len(pairs) == 0): return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # Segments sharing several cells form the same pair more than once.
+    pairs = np.unique(np.sort(np.concatenate(pairs), axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+# Tests the pairs of segments given by the index arrays passed for intersection,
+# returning the unique intersection points as in findSegmentIntersections.
+def intersectPairs(segments, first, second):
+
+    p, r = segments[first, :2], segments[first, 2:] - segments[first, :2]
+    q, s = segments[second, :2], segments[second, 2:] - segments[second, :2]
+
+    # Solve p + t * r = q + u * s. Parallel segments (including collinear and
+    # degenerate ones) have no single intersection point.
+    denominator = cross(r, s)
+    nonParallel = np.abs(denominator) > _EPSILON
+    p, r, q, s, denominator = p[nonParallel], r[nonParallel], q[nonParallel], s[nonParallel], denominator[nonParallel]
+
+    t = cross(q - p, s) / denominator
+    u = cross(q - p, r) / denominator
+
+    onSegments = (t >= -_EPSILON) & (t <= 1 + _EPSILON) & (u >= -_EPSILON) & (u <= 1 + _EPSILON)
+
+    # Segments which only meet at an endpoint they share do not intersect.
+    atEndpoints = (np.minimum(np.abs(t), np.abs(1 - t)) <= _EPSILON) & (np.minimum(np.abs(u), np.abs(1 - u)) <= _EPSILON)
+
+    intersecting = onSegments & ~atEndpoints
+    points = p[intersecting] + t[intersecting, None] * r[intersecting]
+
+    if (len(points) == 0): return []
+
+    points = np.unique(np.round(points, _POINT_PRECISION), axis=0)
+    return [ (float(x), float(y)) for x, y in points ]
+
+# 2D cross product of each row of the (n, 2) arrays passed.
+def cross(a, b):
+    return a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+# Reference implementation testing every pair of segments, one at a time.
+def findSegmentIntersectionsPairwise(segments):
+
+    segments = np.asarray(segments, dtype=float).reshape(-1, 4)
+    count = len(segments)
+
+    first = np.array([ i for i in range(0, count) for j in range(i + 1, count) ], dtype=np.int64)
+    second = np.array([ j for i in range(0, count) for j in range(i + 1, count) ], dtype=np.int64)
+
+    return intersectPairs(segments, first, second)
+
+if (__name__ == "__main__"):
+    # Benchmark against the pairwise reference on random, short segments, as
+    # produced by HoughLinesP.
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", "--segments", type=int, default=2000, help="Number of segments.")
+    ap.add_argument("-s", "--size", type=int, default=1280, help="Side length of the canvas.")
+    args = vars(ap.parse_args())
+
+    random = np.random.RandomState(0)
+    starts = random.randint(0, args['size'], (args['segments'], 2))
+    ends = np.clip(starts + random.randint(-60, 60, (args['segments'], 2)), 0, args['size'])
+    segments = np.concatenate([ starts, ends ], axis=1)
+
+    start = time.perf_counter()
+    intersections = findSegmentIntersections(segments)
+    gridTime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    reference = findSegmentIntersectionsPairwise(segments)
+    pairwiseTime = time.perf_counter() - start
+
+    print("Segments: " + str(len(segments)) + ", intersections: " + str(len(intersections)))
+    print("Grid: " + str(round(gridTime * 1000, 1)) + "ms, pairwise: " + str(round(pairwiseTime * 1000, 1)) + "ms")
+    print("Results match: " + str(intersections == reference))
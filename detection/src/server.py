@@ -1,11 +1,17 @@
 # Waitress wrapper for flask, suitable for production.
 from waitress import serve
 from webserver_flask import app
+from clf.yolo_cnn_detector import warmUp
 import os
 
 _PORT = os.environ.get('PORT')
 _PORT = _PORT if _PORT is not None else '5373'
 
+# Load the YOLO network before accepting requests so that the first detection
+# does not pay for reading the weights from disk.
+print("DETECTION API | Warming up YOLO network")
+warmUp()
+
 print("DETECTION API | Running on port " + str(_PORT))
 
 serve(app, host='0.0.0.0', port=_PORT)
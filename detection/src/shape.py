@@ -16,6 +16,16 @@ def log(message):
 
 class Shape:
 
+    # Shapes are created in large numbers during detection, so attributes are
+    # declared up front rather than stored in a per-instance dict.
+    # Underscored slots back the lazily computed properties below.
+    __slots__ = (
+        'id', 'parentId', 'rawVertices', 'type', '_rawArea', 'boundingBox',
+        '_vertices', '_edges', 'midpoint', '_area', 'width', 'height',
+        '_relativeVertices', '_derivedRelativeVertices', 'content', 'level',
+        'relativeHeight', 'relativeWidth', 'numSides', 'contained'
+    )
+
     def __init__(self, vertices, id=None, shapeType=None, content=False):
         if (type(vertices) != np.ndarray):
             vertices = np.array(vertices)
@@ -25,18 +35,17 @@ class Shape:
         self.rawVertices = vertices
         self.rawVertices = vertices.reshape(-1,2)
         self.type = determineShapeType(self.rawVertices) if shapeType is None else shapeType
-        self.rawArea = calculateArea(self.rawVertices)
+        self._rawArea = None
+        self._relativeVertices = None
         self.boundingBox = getBoundingBox(self.rawVertices) if len(self.rawVertices) > 1 else np.array([])
         # self.vertices = tidyAndApproximate(self.rawVertices, self.type)
         # TEMP: Use Bounding Box a vertices for shape, since specific details about
-        # shape vertices when not using a rectangle is not required.
-        self.vertices = self.boundingBox
-        self.edges = getEdges(self.vertices)
+        # shape vertices when not using a rectangle is not required. Points (e.g.
+        # intersections) have no bounding box, and so keep their vertex.
+        self.vertices = self.boundingBox if len(self.boundingBox) > 0 else self.rawVertices
         self.midpoint = calculateMidpoint(self.vertices)
-        self.area = calculateArea(self.vertices)
         self.width = float(calculateWidth(self.vertices))
         self.height = float(calculateHeight(self.vertices))
-        self.relativeVertices = calculateRelativeVertices(self.vertices[0][0], self.width, self.height, self.vertices, self.vertices)
         self.content = content
 
         # Level describes the level at which the shape is currently nested.
@@ -53,6 +62,48 @@ class Shape:
         # Holds shapes which are contained by the current shape.
         self.contained = []
 
+    # Geometry derived from the vertices is only computed when first accessed,
+    # since most shapes created while resolving predictions are discarded or
+    # only compared by bounding box. Reassigning vertices invalidates it.
+    @property
+    def vertices(self):
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self._vertices = vertices
+        self._edges = None
+        self._area = None
+        self._derivedRelativeVertices = None
+
+    @property
+    def edges(self):
+        if (self._edges is None): self._edges = getEdges(self.vertices)
+        return self._edges
+
+    @property
+    def area(self):
+        if (self._area is None): self._area = calculateArea(self.vertices)
+        return self._area
+
+    @property
+    def rawArea(self):
+        if (self._rawArea is None): self._rawArea = calculateArea(self.rawVertices)
+        return self._rawArea
+
+    # Vertices relative to the containing shape, as set by addContainedShape.
+    # Until then, they are relative to the shape itself.
+    @property
+    def relativeVertices(self):
+        if (self._relativeVertices is not None): return self._relativeVertices
+        if (self._derivedRelativeVertices is None):
+            self._derivedRelativeVertices = calculateRelativeVertices(self.vertices[0][0], self.width, self.height, self.vertices, self.vertices)
+        return self._derivedRelativeVertices
+
+    @relativeVertices.setter
+    def relativeVertices(self, relativeVertices):
+        self._relativeVertices = relativeVertices
+
     def increaseNestLevel(self):
         self.level += 1
         for shape in self.contained:
@@ -92,31 +143,39 @@ class Shape:
         # is contained within this shape, then we can safely assume that it is
         # meant to be contained within it.
 
-        # print("Checking if " + str(otherShape) + " is within "+str(self))
-
         # Check if all vertices are contained within the current shape by using
         # half-plane insideness. [CS324]
-        for edge in self.edges:
-            for vertex in otherShape.vertices:
-                # print(edge)
-                # print(vertex)
-                # print(self.vertices)
-                # print(otherShape.vertices)
-                if not pointWithinPlane(edge, vertex):
-                    # print(str(otherShape) + " not within " + str(self))
-                    # raise "ERR"
-                    return False
-        # print(str(otherShape) + " is within " + str(self))
-        return True
+        return bool(np.all(pointsWithinPolygon(self.vertices, otherShape.vertices)))
 
     # Method uses insideness testing as described above.
     def containsPoint(self, point):
         # Insideness testing for line or point shapes disabled.
         if (len(self.vertices) <= 2): return False
-        for edge in self.edges:
-            if not pointWithinPlane(edge, point):
-                return False
-        return True
+        return bool(pointsWithinPolygon(self.vertices, point)[0])
+
+    # Batch form of containsPoint, returning a boolean array for an (n, 2)
+    # array of points.
+    def containsPoints(self, points):
+        points = np.asarray(points).reshape(-1, 2)
+        if (len(self.vertices) <= 2): return np.zeros(len(points), dtype=bool)
+        return pointsWithinPolygon(self.vertices, points)
+
+    # Batch form of contains, returning a boolean array with an entry for each
+    # of the shapes passed.
+    def containsShapes(self, shapes):
+        if (len(shapes) == 0): return np.zeros(0, dtype=bool)
+        if (len(self.vertices) <= 2): return np.zeros(len(shapes), dtype=bool)
+
+        vertices = [ np.asarray(shape.vertices).reshape(-1, 2) for shape in shapes ]
+        counts = np.array([ len(v) for v in vertices ])
+        inside = pointsWithinPolygon(self.vertices, np.concatenate(vertices))
+
+        # A shape is contained if all of its vertices are. Shapes without
+        # vertices are vacuously contained, as with contains.
+        outside = np.zeros(len(shapes), dtype=int)
+        owners = np.repeat(np.arange(len(shapes)), counts)
+        np.add.at(outside, owners, ~inside)
+        return outside == 0
 
     # Attempts to nest the passed shape as deeply within the current shape
     # as possible.
@@ -187,7 +246,9 @@ class Shape:
 
 # Given the raw vertices detected by cv2.findContour(), and the shape type,
 # attempts to return an approximation of the shape with straight lines.
-def tidyAndApproximate(vertices, type):
+# If 'snapThreshold' is passed, the coordinates of other shapes are snapped
+# together so that nearly straight edges become straight.
+def tidyAndApproximate(vertices, type, snapThreshold=None):
     output = np.array(vertices)
 
     # print("Tidying :" + str(vertices))
@@ -197,6 +258,8 @@ def tidyAndApproximate(vertices, type):
     # equal angles and straigtened out lines.
     if (type == "rectangle"):
         output = getBoundingBox(vertices)
+    elif (snapThreshold is not None):
+        output = snapVertices(output, snapThreshold)
 
     # print("Tidied: " + str(output))
     return output
@@ -212,16 +275,14 @@ def sortShapesBySize(shapes):
 # returning a tuple containing the shape as well as remaining shapes.
 def addContainedToShape(shape, originalShapeList):
 
-    # Make a copy so we don't alter the original list.
-    shapes = originalShapeList.copy()
+    # Skip any shapeToSeeIfContained which is the shape we are adding to. This
+    # makes a copy, so we don't alter the original list.
+    shapes = [ shapeToSeeIfContained for shapeToSeeIfContained in originalShapeList if not shapeToSeeIfContained == shape ]
     output = []
 
-    while (len(shapes) > 0):
-        # Pop shape.
-        shapeToSeeIfContained, shapes = shapes[0], shapes[1:]
-        # Skip if the shapeToSeeIfContained is the shape we are adding to.
-        if (shapeToSeeIfContained == shape): continue
-        if (shape.contains(shapeToSeeIfContained)):
+    # Test all the shapes for containment at once.
+    for shapeToSeeIfContained, contained in zip(shapes, shape.containsShapes(shapes)):
+        if (contained):
             log("Adding:" + str([shapeToSeeIfContained]) + " to " + str([shape]))
             shape.addContainedShape(shapeToSeeIfContained)
         else:
@@ -235,6 +296,25 @@ def addContainedToShape(shape, originalShapeList):
     # front of the shapes list and appending this to the back of the output list.
     return shape, output
 
+# Scales the coordinates of the shapes passed (and all shapes they contain) by
+# 'factor', e.g. to map shapes detected on a downscaled image back to the
+# original. Relative sizes and positions are unaffected.
+def rescaleShapes(shapes, factor):
+    scale = lambda vertices: np.round(np.asarray(vertices) * factor).astype(int).reshape(-1, 2) if len(vertices) > 0 else vertices
+    for shape in shapes:
+        # Vertices are usually the bounding box itself, in which case they
+        # should remain the same array.
+        verticesAreBoundingBox = shape.vertices is shape.boundingBox
+        shape.rawVertices = scale(shape.rawVertices)
+        shape.boundingBox = scale(shape.boundingBox)
+        shape.vertices = shape.boundingBox if verticesAreBoundingBox else scale(shape.vertices)
+        if (len(shape.vertices) > 0):
+            shape.midpoint = calculateMidpoint(shape.vertices)
+            shape.width = float(calculateWidth(shape.vertices))
+            shape.height = float(calculateHeight(shape.vertices))
+        rescaleShapes(shape.contained, factor)
+    return shapes
+
 # Ensures that all shapes are contained within a global container.
 def nestWithinWindow(shapes, imgDimensions):
     # If the highest level of the output has more than a single container, then we nest all the shapes within
@@ -255,8 +335,65 @@ def nestWithinWindow(shapes, imgDimensions):
 
 # Iterates through each shape detected, checking to see if it contains other shapes.
 # Returns a dictionary of shapes representing the hierarchical structure.
+#
+# Shapes are visited in descending order of area. Each one is placed beneath the
+# first (largest) shape at the top level which contains it, then the first of
+# that shape's children which contains it, and so on, which is the hierarchy
+# produced by nestShapesPairwise. Candidate parents are looked up in a BoxIndex
+# of bounding boxes, so only the containers of each shape are examined rather
+# than every other shape. Falls back to nestShapesPairwise for shapes which are
+# not axis-aligned rectangles or which are already nested.
 def nestShapes(shapes):
 
+    if (len(shapes) == 0): return shapes
+
+    # Sort shapes by size.
+    shapes = sortShapesBySize(shapes)
+
+    boxes = [ getAxisAlignedBox(shape.vertices) for shape in shapes ]
+    if (any(box is None for box in boxes) or any(len(shape.contained) > 0 for shape in shapes)):
+        return nestShapesPairwise(shapes)
+
+    index = BoxIndex(boxes)
+    placed = np.zeros(len(shapes), dtype=bool)
+    parents = np.full(len(shapes), -1)
+    siblingsByBox = {}
+    roots = []
+
+    for i, shape in enumerate(shapes):
+
+        # Containment is strict, so every container of the shape is larger and
+        # has already been visited.
+        containers = index.containing(boxes[i])
+        containers = containers[placed[containers]]
+
+        # Descend from the top level, taking the first container at each level.
+        parent = -1
+        while (True):
+            children = containers[parents[containers] == parent]
+            if (len(children) == 0): break
+            parent = children.min()
+
+        # Shapes identical to one already at this level are discarded, as in
+        # addContainedToShape.
+        siblings = siblingsByBox.setdefault((parent, boxes[i]), [])
+        if (any(shapes[j] == shape for j in siblings)): continue
+        siblings.append(i)
+
+        placed[i] = True
+        parents[i] = parent
+
+        if (parent == -1): roots.append(shape)
+        else:
+            log("Adding:" + str([shape]) + " to " + str([shapes[parent]]))
+            shapes[parent].addContainedShape(shape)
+
+    return roots
+
+# Reference implementation of nestShapes which recursively tests every remaining
+# shape against the largest one.
+def nestShapesPairwise(shapes):
+
     if (len(shapes) == 0): return shapes
     # Sort shapes by size.
     shapes = sortShapesBySize(shapes)
@@ -279,10 +416,10 @@ def nestShapes(shapes):
 
     # For all shapes that have been added to the current shape, perform the
     # same procedure recursively.
-    shape.contained = nestShapes(shape.contained)
+    shape.contained = nestShapesPairwise(shape.contained)
 
     # Process the rest of the list until it is empty, returning a list containing
     # shapes which contain all others.
 
 
-    return [shape] + nestShapes(remaining)
+    return [shape] + nestShapesPairwise(remaining)
@@ -5,16 +5,52 @@
 from findContainer import getContainers, nestShapes
 from detectLine import detectAndNestIntersections, detectAndNestLines
 from shapesToJSON import serialiseShapeHierachy, composeShapeHierarchy
-from clf.yolo_cnn_detector import predict_primitives, draw_pred
+from clf.yolo_cnn_detector import predict_primitives, predict_primitives_tiled
 from resolvePrediction import resolveShapesUsingPredictions, resolveTextUsingPredictions
 from textDetect import detectTextFromImage
+from resultCache import computeKey, createFromEnv
+import clf.yolo_cnn_detector as yoloDetector
+import resolvePrediction
+import textDetect
 from util import renumberShapeIds
+from shape import rescaleShapes
+from preprocess import preprocess
+from shapeHierarchy import ContainmentIndex
 import cv2
 import os
 import imutils
+import math
+import numpy as np
 import json
 import argparse
 import sys
+import base64
+from concurrent.futures import ThreadPoolExecutor
+
+# Shared pool used to overlap the independent detection stages. OpenCV and the
+# OCR client release the GIL while they work, so threads are sufficient.
+_STAGE_POOL_SIZE = 6
+_stagePool = ThreadPoolExecutor(max_workers=_STAGE_POOL_SIZE)
+
+# Bumped whenever a change to the pipeline alters its output, so that stale
+# cached results are not served.
+_PIPELINE_VERSION = 2
+
+# Images with more pixels than this are downscaled once (keeping their aspect
+# ratio) before contour detection and resolution, and the detected shapes are
+# mapped back to the original image coordinates before serialisation. Bounding
+# the pixel count, rather than the width, also bounds memory for tall scrolling
+# screenshots. The default matches a 1280x960 image. 0 disables downscaling.
+_WORKING_PIXELS = int(os.getenv('DETECT_WORKING_PIXELS', 1280 * 960))
+
+# When set, primitives are predicted over overlapping tiles of the working image
+# as well as over the whole (squashed) image, which recovers small primitives on
+# large canvases at the cost of a larger (but bounded) batch.
+_TILED_CNN = os.getenv('DETECT_TILED_CNN') is not None
+
+# When set, intersections and horizontal lines are detected and nested within
+# the containers found, for use in the inference pipeline.
+_DETECT_LINES = os.getenv('DETECT_LINES') is not None
 
 def log(*msg):
     if os.getenv('PY_DEBUG') is not None:
@@ -47,11 +83,22 @@ def outputResultsToDir(dir, filename, json, annotated=None, containers=None, int
     if (full_detections is not None): cv2.imwrite(args['output']+'/'+filename+'/'+filename+'_full_detection.png', full_detections)
 
 
-def getFreshImage(imagePath, resize=False):
-    image = cv2.imread(imagePath)
-    image = imutils.resize(image, width=300 if resize else None)
+# Decodes the image passed to detectShapes, which may be a path on disk, the raw
+# (encoded) bytes of an image file, or an image already decoded by OpenCV.
+def loadImage(source):
+    if (isinstance(source, np.ndarray)): return source
+    if (isinstance(source, (bytes, bytearray))):
+        image = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_COLOR)
+    else:
+        image = cv2.imread(source)
+    if (image is None): raise ValueError("Could not decode image.")
     return image
 
+# Returns a copy of the decoded image that can be drawn on without affecting the
+# source.
+def getFreshImage(image, resize=False):
+    return imutils.resize(image.copy(), width=300 if resize else None)
+
 def drawShapes(shapes, image):
 
     if (shapes is None or len(shapes) == 0): return
@@ -66,53 +113,137 @@ def drawShapes(shapes, image):
 
     return image
 
-def detectShapes(imagePath):
-
-    # Load the image.
-    originalImg = cv2.imread(imagePath)
-    image = cv2.imread(imagePath)
-    originalImg = imutils.resize(originalImg)
-    image = imutils.resize(image)
-
-
-    # Get containers.
-    shapes, appxConts, containerImg, whiteImg = getContainers(image, annotate=True)
-
-    # Detect presence of complex shape primitives using YOLO CNN.
-    primitives = predict_primitives(getFreshImage(imagePath), image.shape)
-
-    # Detect presence of text using Google Cloud Vision API.
-    textPredictions = []
-    textImg = getFreshImage(imagePath)
-
-    # Safely attempt to detect text (handle spotty internet connections).
+# Returns the settings which affect the output of detectShapes. These form part
+# of the result cache key.
+def getPipelineConfig():
+    return {
+        'version': _PIPELINE_VERSION,
+        'cnnConfidenceThreshold': yoloDetector._CONFIDENCE_THRESHOLD,
+        'iouThreshold': resolvePrediction._IOU_THRESHOLD,
+        'assignmentMode': resolvePrediction._ASSIGNMENT_MODE,
+        'textConfidenceThreshold': resolvePrediction._TEXT_CONFIDENCE_THRESHOLD,
+        'ocrBackend': textDetect._OCR_BACKEND,
+        'workingPixels': _WORKING_PIXELS,
+        'tiledCNN': _TILED_CNN,
+        'detectLines': _DETECT_LINES
+    }
+
+# Returns the bytes identifying the image passed to detectShapes for caching.
+def getImageBytes(source):
+    if (isinstance(source, np.ndarray)): return str(source.shape).encode('utf8') + source.tobytes()
+    return bytes(source)
+
+# Returns the image downscaled so that it has at most the working number of
+# pixels (if it is larger), along with the factor by which it was scaled.
+def getWorkingImage(image, workingPixels=_WORKING_PIXELS):
+    height, width = image.shape[:2]
+    if (not workingPixels or width * height <= workingPixels): return image, 1.0
+    workingImg = imutils.resize(image, width=max(int(width * math.sqrt(workingPixels / (width * height))), 1))
+    return workingImg, workingImg.shape[1] / width
+
+# Scales the bounding rects of text predictions by the factor passed.
+def scaleTextPredictions(textPredictions, scale):
+    if (scale == 1.0): return textPredictions
+    return [
+        (word, confidence, [ [int(round(x * scale)), int(round(y * scale))] for x, y in bounding_rect ])
+        for word, confidence, bounding_rect in textPredictions
+    ]
+
+# Safely attempt to detect text (handle spotty internet connections). Returns
+# None if text detection failed, so that the caller can avoid caching a result
+# which is missing its text.
+def detectTextSafely(image, ext, annotate):
     try:
-        textPredictions, textImg = detectTextFromImage(textImg, '.'+imagePath.split('.')[-1])
-    except: pass
-
-    # Draw all shapes detected by the CNN.
-    cnnPredsImg = getFreshImage(imagePath)
-    for (x, y, w, h), vertices, label, id, confidence in primitives:
-        draw_pred(cnnPredsImg, id, confidence, x, y, x+w, y+h)
+        return detectTextFromImage(image, ext, annotate=annotate)
+    except Exception as e:
+        log("Text detection failed:", e)
+        return None
+
+# Runs the full detection pipeline. When 'annotate' is False (e.g. for API
+# requests) no annotation canvases are created and the returned images are None;
+# every stage reads from the single decoded source buffer instead.
+# When 'concurrent' is True, contour detection, the CNN and OCR run in parallel
+# on the stage pool, since they are independent until resolution.
+# If a ResultCache is passed and no annotations are requested, results are looked
+# up by image content and pipeline config first. On a cache hit the pipeline is
+# skipped entirely and only the hierarchy is returned (shapes is None).
+def detectShapes(source, ext='.png', annotate=True, concurrent=False, cache=None):
+
+    if (isinstance(source, str)):
+        ext = '.'+source.split('.')[-1]
+
+        # Read the file once so the same bytes can be hashed and decoded.
+        if (cache is not None and not annotate):
+            with open(source, 'rb') as file:
+                source = file.read()
+
+    cacheKey = None
+    if (cache is not None and not annotate):
+        cacheKey = computeKey(getImageBytes(source), getPipelineConfig())
+        jsonHierarchy = cache.get(cacheKey)
+        if (jsonHierarchy is not None): return jsonHierarchy, None, None, None
+
+    # Decode the image once. Stages which only read from the image share this
+    # buffer, and drawable copies are made only when annotations are requested.
+    sourceImg = loadImage(source)
+
+    # Contour detection and resolution run at the working resolution; shapes
+    # are scaled back to the source image before serialisation.
+    workingImg, scale = getWorkingImage(sourceImg)
+
+    # Binarise the working image once; container and line detection share it.
+    preprocessed = preprocess(workingImg)
+
+    stages = [
+        # Get containers. Annotation draws onto the image passed, so it gets its own copy.
+        # The label map of the containers is only needed to nest intersections.
+        lambda: getContainers(getFreshImage(workingImg) if annotate else workingImg, annotate=annotate, preprocessed=preprocessed, labelMap=_DETECT_LINES),
+        # Detect presence of complex shape primitives using YOLO CNN, on the
+        # working image so that the number of tiles stays bounded.
+        (lambda: predict_primitives_tiled(workingImg)) if _TILED_CNN else (lambda: predict_primitives(workingImg, workingImg.shape)),
+        # Detect presence of text using Google Cloud Vision API. Text is read
+        # from the full resolution image.
+        lambda: detectTextSafely(getFreshImage(sourceImg) if annotate else sourceImg, ext, annotate)
+    ]
+
+    if (concurrent):
+        futures = [ _stagePool.submit(stage) for stage in stages ]
+        results = [ future.result() for future in futures ]
+    else:
+        results = [ stage() for stage in stages ]
+
+    (shapes, appxConts, containerImg, whiteImg, labelMap), primitives, textResult = results
+    if (not annotate): containerImg = None
+
+    # Results are still returned without text if text detection failed, but
+    # are not cached, so that a transient failure is retried on the next request.
+    textFailed = textResult is None
+    textPredictions, textImg = textResult if not textFailed else ([], None)
+
+    textPredictions = scaleTextPredictions(textPredictions, scale)
 
     lastShapeId = len(appxConts)
 
-    # For each container, detect the intersections within the container in order to infer
-    # images in the inference pipeline.
-    # Need to pass in the 'lastShapeId' so that we enumerate intersection shape ids
-    # starting from the last detected shape id in the getContainers method.
-    # _, intersections, intersectionImg = detectAndNestIntersections(originalImg, shapes, lastShapeId=lastShapeId, annotate=True)
+    if (_DETECT_LINES):
+        # Index the containers once for nesting both intersections and lines.
+        # The intersections nested first never contain other shapes, so the
+        # index stays valid for the lines.
+        containmentIndex = ContainmentIndex(shapes)
 
-    # Update lastShapeId
-    # lastShapeId += len(intersections)
+        # For each container, detect the intersections within the container in order to infer
+        # images in the inference pipeline.
+        # Need to pass in the 'lastShapeId' so that we enumerate intersection shape ids
+        # starting from the last detected shape id in the getContainers method.
+        _, intersections, intersectionImg = detectAndNestIntersections(getFreshImage(workingImg) if annotate else workingImg, shapes, lastShapeId=lastShapeId, annotate=annotate, preprocessed=preprocessed, labelMap=labelMap, index=containmentIndex)
 
-    # For each container, detect lines and nest horizontal lines which occur
-    # roughly around the vertical center of the container.
-    # _, lines, lineImg = detectAndNestLines(getFreshImage(args["image"]), shapes, lastShapeId=lastShapeId, annotate=True)
+        # Update lastShapeId
+        lastShapeId += len(intersections)
 
-    # print("SHAPES AFTER NESTING INTERSECTIONS:  "+ str(shapes) + ", " + str(shapes[0].contained))
+        # For each container, detect lines and nest horizontal lines which occur
+        # roughly around the vertical center of the container.
+        _, lines, lineImg = detectAndNestLines(getFreshImage(workingImg) if annotate else workingImg, shapes, lastShapeId=lastShapeId, annotate=annotate, preprocessed=preprocessed, index=containmentIndex)
 
-    # lastShapeId += len(lines)
+        lastShapeId += len(lines) if lines is not None else 0
 
     # Given the predicted primitives and the shapes collected from the previous
     # step, attempt to identify each shape correctly using bounding box information
@@ -128,22 +259,72 @@ def detectShapes(imagePath):
     # due to filtering.
     shapes, _ = renumberShapeIds(shapes)
 
+    # Map shapes back to the coordinates of the source image.
+    if (scale != 1.0): rescaleShapes(shapes, 1 / scale)
+
     # Draw all detected primitives.
-    fullPrimitivesImg = drawShapes(shapes, getFreshImage(imagePath))
+    fullPrimitivesImg = drawShapes(shapes, getFreshImage(sourceImg)) if annotate else None
 
     # Get serialised hierarchy.
     jsonHierarchy = composeShapeHierarchy(shapes)
 
+    if (cacheKey is not None and not textFailed): cache.put(cacheKey, jsonHierarchy)
+
     return jsonHierarchy, fullPrimitivesImg, containerImg, shapes
 
+# Runs a single job received in worker mode. Jobs either reference an image on
+# disk through 'image', or carry the encoded image as base64 under 'bytes'.
+def runJob(job, cache=None):
+    if (job.get('image') is not None):
+        jsonHierarchy, _, _, _ = detectShapes(job['image'], annotate=False, concurrent=True, cache=cache)
+        return jsonHierarchy
+
+    if (job.get('bytes') is None):
+        raise ValueError("Job must contain either 'image' or 'bytes'.")
+
+    jsonHierarchy, _, _, _ = detectShapes(base64.b64decode(job['bytes']), ext=job.get('ext', '.png'), annotate=False, concurrent=True, cache=cache)
+    return jsonHierarchy
+
+# Long-lived worker mode. Reads newline-delimited JSON jobs from the input stream
+# and writes one JSON result per line to the output stream, so that callers can
+# keep a single process (with cv2, the YOLO network and the OCR client already
+# loaded) around for many images instead of spawning one per image.
+def serveStdio(inputStream=sys.stdin, outputStream=sys.stdout):
+    cache = createFromEnv()
+    for line in inputStream:
+        line = line.strip()
+        if (line == ""): continue
+
+        jobId = None
+        try:
+            job = json.loads(line)
+            jobId = job.get('id')
+            response = { "id": jobId, "success": True, "result": runJob(job, cache) }
+        except Exception as e:
+            log("Job", jobId, "failed:", e)
+            response = { "id": jobId, "success": False, "reason": str(e) }
+
+        outputStream.write(json.dumps(response) + "\n")
+        outputStream.flush()
+
 
 if (__name__ == "__main__"):
     ap = argparse.ArgumentParser()
-    ap.add_argument("-i", "--image", required=True, help="Input path.")
+    ap.add_argument("-i", "--image", required=False, help="Input path.")
     ap.add_argument("-o", "--output", required=False)
+    ap.add_argument("--serve-stdio", action="store_true", help="Process newline-delimited JSON jobs from stdin until EOF.")
+    ap.add_argument("--concurrent", action="store_true", help="Run contour, CNN and text detection in parallel.")
     args = vars(ap.parse_args())
 
-    jsonHierarchy, fullPrimitivesImg, containerImg, shapes = detectShapes(args["image"])
+    if (args["serve_stdio"]):
+        serveStdio()
+        sys.exit(0)
+
+    if (args["image"] is None):
+        ap.error("the following arguments are required: -i/--image")
+
+    # Annotations are only drawn when they are written to the output directory.
+    jsonHierarchy, fullPrimitivesImg, containerImg, shapes = detectShapes(args["image"], annotate=args["output"] is not None, concurrent=args["concurrent"])
 
     if (args["output"]):
         filename = args["image"].split('/')[-1].split('.')[0]
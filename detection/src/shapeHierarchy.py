@@ -0,0 +1,176 @@
+# Flattened representations of a nested shape hierarchy.
+#
+# Rather than walking the tree of Shape objects, the hierarchy is held as a list
+# of shapes in depth-first order alongside NumPy arrays of the parent row and
+# level of each shape, so that many shapes can be queried at once.
+
+import numpy as np
+
+# Nested list of shapes flattened in depth-first order.
+class FlattenedHierarchy:
+
+    def __init__(self, shapes, parents, levels):
+        self.shapes = shapes
+        # Parents are row indices into the same list, with -1 for top level shapes.
+        self.parents = np.asarray(parents, dtype=np.int32).reshape(-1)
+        self.levels = np.asarray(levels, dtype=np.int16).reshape(-1)
+
+    def __len__(self):
+        return len(self.shapes)
+
+    # Flattens a nested list of shapes in depth-first order, with parent rows
+    # and levels following the hierarchy.
+    @staticmethod
+    def fromShapes(shapes):
+        flattened = []
+        parents = []
+
+        def visit(shapes, parentRow):
+            for shape in shapes:
+                flattened.append(shape)
+                parents.append(parentRow)
+                visit(shape.contained, len(flattened) - 1)
+
+        visit(shapes, -1)
+
+        return FlattenedHierarchy(flattened, parents, [ shape.level for shape in flattened ])
+
+# Precomputed index over a nested shape hierarchy for answering, in bulk, which
+# shapes contain a set of points. The hierarchy is flattened once, in
+# depth-first order, along with the extent of each shape's vertices. A shape is
+# then only tested against the points its parent contains which fall within its
+# extent, and subtrees whose root contains none of the points are skipped, so
+# lookups touch only the shapes along the paths to the points rather than every
+# shape in the hierarchy.
+#
+# The index is a snapshot: shapes nested into the hierarchy after it is built
+# are not considered.
+class ContainmentIndex:
+
+    def __init__(self, shapes):
+        self.hierarchy = FlattenedHierarchy.fromShapes(shapes)
+        self.shapes = self.hierarchy.shapes
+        self.parents = self.hierarchy.parents
+        self.levels = self.hierarchy.levels
+        self.midpoints = np.array([ shape.midpoint for shape in self.shapes ], dtype=float).reshape(-1, 2)
+        self.heights = np.array([ shape.height for shape in self.shapes ], dtype=float)
+
+        # Inclusive (x0, y0, x1, y1) extent of the vertices of each shape. Shapes
+        # with two vertices or fewer never contain points, so get a row of NaN.
+        self.extents = np.full((len(self.shapes), 4), np.nan)
+        for row, shape in enumerate(self.shapes):
+            if (len(shape.vertices) <= 2): continue
+            vertices = np.asarray(shape.vertices, dtype=float).reshape(-1, 2)
+            self.extents[row] = (*vertices.min(axis=0), *vertices.max(axis=0))
+
+        # The row following the last descendant of each row.
+        self.ends = np.arange(1, len(self.shapes) + 1)
+        for row in range(len(self.shapes) - 1, -1, -1):
+            if (self.parents[row] != -1):
+                self.ends[self.parents[row]] = max(self.ends[self.parents[row]], self.ends[row])
+
+    def __len__(self):
+        return len(self.shapes)
+
+    # Returns an (n, rows) boolean mask selecting, for each of the n points
+    # passed, the shapes which contain the point (using Shape.containsPoints)
+    # along with all of their ancestors, i.e. the shapes reached by descending
+    # from the top level only through shapes containing the point.
+    def getContainingMask(self, points):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        mask = np.zeros((len(points), len(self)), dtype=bool)
+        everyPoint = np.arange(len(points))
+
+        row = 0
+        while (row < len(self)):
+            parent = self.parents[row]
+            candidates = everyPoint if parent == -1 else np.flatnonzero(mask[:, parent])
+
+            # Narrow down the candidates to those within the shape's extent
+            # before testing them against the shape itself.
+            if (len(candidates) > 0):
+                x0, y0, x1, y1 = self.extents[row]
+                xs, ys = points[candidates, 0], points[candidates, 1]
+                candidates = candidates[(xs >= x0) & (xs <= x1) & (ys >= y0) & (ys <= y1)]
+
+            # None of the points can be contained by the shape's descendants.
+            if (len(candidates) == 0):
+                row = self.ends[row]
+                continue
+
+            mask[candidates, row] = self.shapes[row].containsPoints(points[candidates])
+            row += 1
+
+        return mask
+
+    # For each row of the mask, descends from the top level into the first
+    # selected shape at each level, returning the row of the deepest shape
+    # reached, or -1 if no top level shape is selected.
+    def getFirstDeepest(self, mask):
+        current = np.full(len(mask), -1)
+        if (len(self) == 0): return current
+        while True:
+            candidates = mask & (self.parents[None, :] == current[:, None])
+            found = candidates.any(axis=1)
+            if (not found.any()): return current
+            current = np.where(found, candidates.argmax(axis=1), current)
+
+    # For each row of the mask, returns the row of the selected shape with the
+    # highest nesting level (the first in depth-first order if there are
+    # several), or -1 if no shape is selected.
+    def getHighestLevel(self, mask):
+        if (len(self) == 0): return np.full(len(mask), -1)
+        levels = np.where(mask, self.levels[None, :], -1)
+        return np.where(mask.any(axis=1), levels.argmax(axis=1), -1)
+
+    # Returns the shapes at the rows passed, with None for -1.
+    def getShapes(self, rows):
+        return [ self.shapes[row] if row != -1 else None for row in rows ]
+
+# Raster of a nested shape hierarchy, mapping each pixel of an image to the row
+# (in the flattened hierarchy) of the innermost shape whose bounding
+# box contains it, or -1 for pixels outside every shape. Bounding boxes are
+# filled parents first, so deeper shapes overwrite their containers, and
+# siblings last to first, so among overlapping siblings the first wins. This
+# matches ContainmentIndex.getFirstDeepest, which descends into the first
+# containing shape at each level.
+#
+# Once built, finding the innermost shape containing a point is an array lookup,
+# accurate to the pixel. The map should be built at the working resolution, as
+# it holds one int32 per pixel. Like ContainmentIndex, it is a snapshot of the
+# hierarchy it was built from.
+class LabelMap:
+
+    def __init__(self, shapes, size):
+        height, width = size[:2]
+        self.hierarchy = FlattenedHierarchy.fromShapes(shapes)
+        self.shapes = self.hierarchy.shapes
+        self.labels = np.full((height, width), -1, dtype=np.int32)
+
+        rows = { id(shape): row for row, shape in enumerate(self.shapes) }
+
+        def fill(shapes):
+            for shape in reversed(shapes):
+                if (len(shape.boundingBox) == 4):
+                    (x0, y0), _, (x1, y1), _ = shape.boundingBox
+                    # Only pixels strictly inside the box are contained, as in Shape.contains.
+                    self.labels[max(y0 + 1, 0):max(y1, 0), max(x0 + 1, 0):max(x1, 0)] = rows[id(shape)]
+                fill(shape.contained)
+
+        fill(shapes)
+
+    # Returns the row of the innermost shape containing each of the (x, y) points
+    # passed, or -1. Points are rounded to the nearest pixel, and points outside
+    # the image are not contained by any shape.
+    def getRows(self, points):
+        points = np.round(np.asarray(points, dtype=float).reshape(-1, 2)).astype(int)
+        xs, ys = points[:, 0], points[:, 1]
+        height, width = self.labels.shape
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        rows = np.full(len(points), -1, dtype=np.int32)
+        rows[inside] = self.labels[ys[inside], xs[inside]]
+        return rows
+
+    # Returns the innermost shape containing each of the points passed, or None.
+    def getShapes(self, points):
+        return [ self.shapes[row] if row != -1 else None for row in self.getRows(points) ]
@@ -56,7 +56,7 @@ if (__name__ == "__main__"):
     image = imutils.resize(image, width=300)
 
     # Get containers from the image as a list of shapes.
-    containers, approximatedContours, image, whiteImg = getContainers(image)
+    containers, approximatedContours, image, whiteImg, _ = getContainers(image)
 
     # Infer hierarchy.
     containers = nestShapes(containers)
@@ -3,17 +3,134 @@
 #
 # @ Aaron Baw 2019
 
-from google.cloud import vision
-from google.cloud.vision import types
 import os
 import io
 import cv2
 import numpy as np
 import json
-
-
-# Instantiates a client
-client = vision.ImageAnnotatorClient()
+import hashlib
+import threading
+import time
+import urllib.request
+from abc import ABC, abstractmethod
+from resultCache import ResultCache, computeKey
+
+# Selects the OCR backend used by detectTextFromImage: 'cloud_vision' (default),
+# 'fixture' (offline, reads detections from _OCR_FIXTURE_PATH) or 'http' (posts
+# the image to a local stub server at _OCR_ENDPOINT).
+_OCR_BACKEND = os.getenv('OCR_BACKEND', 'cloud_vision')
+_OCR_FIXTURE_PATH = os.getenv('OCR_FIXTURE_PATH')
+_OCR_ENDPOINT = os.getenv('OCR_ENDPOINT', 'http://localhost:5374/ocr')
+
+# Raw detections are cached by image digest, so re-runs which only change the
+# thresholds used to resolve them skip the OCR call. Setting OCR_CACHE_SIZE to 0
+# disables the cache; OCR_CACHE_TTL is in seconds. If OCR_CACHE_DIR is set,
+# detections are also written to that directory, so that they persist across
+# runs (OCR_CACHE_DISK_SIZE bounds the number of entries kept there).
+_OCR_CACHE_SIZE = int(os.getenv('OCR_CACHE_SIZE', 256))
+_OCR_CACHE_TTL = float(os.getenv('OCR_CACHE_TTL', 3600))
+_OCR_CACHE_DIR = os.getenv('OCR_CACHE_DIR')
+_OCR_CACHE_DISK_SIZE = int(os.getenv('OCR_CACHE_DISK_SIZE', 4096))
+_ocrCache = ResultCache(_OCR_CACHE_SIZE, directory=_OCR_CACHE_DIR, ttl=_OCR_CACHE_TTL, maxDiskSize=_OCR_CACHE_DISK_SIZE) if _OCR_CACHE_SIZE > 0 else None
+
+def log(msg):
+    if os.getenv('PY_DEBUG') is not None:
+        print("TEXT DETECT | " + str(msg))
+
+# Interface implemented by every OCR backend. Given the encoded bytes of an image,
+# returns a list of (word, confidence, bounding_rect) detections, where
+# bounding_rect is a list of four vertices as produced by formatIntoBoundingBox.
+class OCRBackend(ABC):
+
+    @abstractmethod
+    def detect(self, imageBytes):
+        pass
+
+# Google Cloud Vision implementation. The client (and the google.cloud import)
+# is only created on first use, so importing this module stays cheap.
+class CloudVisionBackend(OCRBackend):
+
+    def __init__(self):
+        self.client = None
+        self.lock = threading.Lock()
+
+    def getClient(self):
+        if (self.client is None):
+            with self.lock:
+                if (self.client is None):
+                    from google.cloud import vision
+                    self.client = vision.ImageAnnotatorClient()
+        return self.client
+
+    def detect(self, imageBytes):
+        from google.cloud.vision import types
+
+        # Performs label detection on the image file
+        response = self.getClient().document_text_detection(image=types.Image(content=imageBytes))
+
+        return collectTextDetections(response)
+
+# Offline implementation which serves detections from a JSON fixture file. The
+# file maps fixture keys to a list of [word, confidence, bounding_rect] entries,
+# with an optional 'default' entry for images that are not listed. 'latency'
+# (seconds) can be used to simulate a network round-trip when benchmarking.
+#
+# Backends are passed the image as re-encoded by the pipeline rather than the
+# source file, so the fixture key of an image is the SHA-1 hex digest of those
+# bytes (see getFixtureKey). Keys for image files can be printed with
+# `python ocrStubServer.py --key IMAGE [IMAGE ...]`.
+class FixtureBackend(OCRBackend):
+
+    def __init__(self, fixturePath=None, fixtures=None, latency=0):
+        if (fixtures is None):
+            fixtures = json.load(open(fixturePath)) if fixturePath is not None else {}
+        self.fixtures = fixtures
+        self.latency = latency
+
+    def detect(self, imageBytes):
+        if (self.latency > 0): time.sleep(self.latency)
+        digest = hashlib.sha1(imageBytes).hexdigest()
+        detections = self.fixtures.get(digest, self.fixtures.get('default', []))
+        return [ (word, confidence, bounding_rect) for word, confidence, bounding_rect in detections ]
+
+# Returns the FixtureBackend key of the image file at the path passed: the SHA-1
+# hex digest of the image once decoded and re-encoded (in the same format) as
+# detectTextFromImage does.
+def getFixtureKey(imagePath):
+    image = cv2.imread(imagePath)
+    if (image is None): raise ValueError("Could not decode image '" + imagePath + "'.")
+    return hashlib.sha1(cv2.imencode('.' + imagePath.split('.')[-1], image)[1].tobytes()).hexdigest()
+
+# Implementation which posts the image to an HTTP endpoint (such as the stub
+# server in ocrStubServer.py) and expects the detections back as a JSON list.
+class HTTPBackend(OCRBackend):
+
+    def __init__(self, endpoint=_OCR_ENDPOINT, timeout=10):
+        self.endpoint = endpoint
+        self.timeout = timeout
+
+    def detect(self, imageBytes):
+        request = urllib.request.Request(self.endpoint, data=imageBytes, headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            detections = json.loads(response.read().decode('utf8'))
+        return [ (word, confidence, bounding_rect) for word, confidence, bounding_rect in detections ]
+
+_backend = None
+
+# Returns the OCR backend in use, creating it from the environment on first use.
+def getOCRBackend():
+    global _backend
+    if (_backend is None):
+        if (_OCR_BACKEND == 'fixture'): _backend = FixtureBackend(_OCR_FIXTURE_PATH)
+        elif (_OCR_BACKEND == 'http'): _backend = HTTPBackend()
+        elif (_OCR_BACKEND == 'cloud_vision'): _backend = CloudVisionBackend()
+        else: raise ValueError("Unknown OCR backend '" + _OCR_BACKEND + "'.")
+    return _backend
+
+# Overrides the OCR backend, e.g. to benchmark the pipeline without the network.
+def setOCRBackend(backend):
+    global _backend
+    _backend = backend
 
 
 def getBoundingRectFromBoundingPoly(vertices):
@@ -63,24 +180,33 @@ def collectTextDetections(response):
                 #
     return detections
 
-# Given an image read in with OpenCV, returns an array of text detections and
-# corresponding bounding boxes.
-def detectTextFromImage(image, ext='.png', annotate=True):
+# Returns the OCR cache key for the decoded image passed. The key is a digest of
+# the decoded buffer (and its shape), so that cache hits don't need the image to
+# be encoded first.
+def getCacheKey(image, ext, backend):
+    buffer = np.ascontiguousarray(image)
+    return computeKey(memoryview(buffer), { 'backend': type(backend).__name__, 'ext': ext, 'shape': list(buffer.shape) })
 
-    detections = []
+# Returns the raw detections for the image, consulting the OCR cache before
+# encoding the image and calling the backend.
+def detectTextFromBuffer(image, ext, backend):
 
-    byteImage = cv2.imencode(ext, image)[1].tostring()
+    if (_ocrCache is None): return backend.detect(cv2.imencode(ext, image)[1].tobytes())
 
-    byteImage = types.Image(content=byteImage)
+    cacheKey = getCacheKey(image, ext, backend)
+    detections = _ocrCache.get(cacheKey)
 
-    # Performs label detection on the image file
-    response = client.document_text_detection(image=byteImage)
+    if (detections is None):
+        detections = backend.detect(cv2.imencode(ext, image)[1].tobytes())
+        _ocrCache.put(cacheKey, detections)
 
-    detections = collectTextDetections(response)
+    return [ (word, confidence, bounding_rect) for word, confidence, bounding_rect in detections ]
 
-    text = response.text_annotations
+# Given an image read in with OpenCV, returns an array of text detections and
+# corresponding bounding boxes.
+def detectTextFromImage(image, ext='.png', annotate=True, backend=None):
 
-    vertices = []
+    detections = detectTextFromBuffer(image, ext, backend if backend is not None else getOCRBackend())
 
     if annotate:
         image = drawPredictionsOnImage(image, detections)
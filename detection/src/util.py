@@ -11,7 +11,7 @@ def renumberShapeIds(shapes, parentId=None, lastShapeId=0):
     for shape in shapes:
         shape.id = lastShapeId = lastShapeId + 1
         shape.parentId = parentId
-        shape.contains, lastShapeId = renumberShapeIds(shape.contained, shape.id, lastShapeId)
+        shape.contained, lastShapeId = renumberShapeIds(shape.contained, shape.id, lastShapeId)
 
     return shapes, lastShapeId
 
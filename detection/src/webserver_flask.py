@@ -11,15 +11,18 @@ from flask_restful import Resource, Api, reqparse
 from json import dumps
 import werkzeug
 import os
-import shutil
 
 # Dependencies for shape detection.
 from shapeDetect import detectShapes
+from resultCache import createFromEnv
 
-_SERVER_STORAGE_DIR = "./.server_storage/temp/"
 _API_PREFIX = '/api/v1'
 _PORT = os.environ.get('DETECTION_WEBSERVER_PORT') if not os.environ.get('DETECTION_WEBSERVER_PORT') is not None else '5373'
 
+# Results are cached by image content, so re-submitted wireframes are served
+# without re-running detection.
+_RESULT_CACHE = createFromEnv()
+
 app = Flask(__name__)
 api = Api(app)
 
@@ -35,32 +38,23 @@ class ShapeDetect(Resource):
         args = parse.parse_args()
         image = args['Image']
 
-        # Check the temp storage directory has been created.
-        if not os.path.exists(_SERVER_STORAGE_DIR):
-            os.makedirs(_SERVER_STORAGE_DIR)
-
         if image is None:
             return {
                 "success": False,
                 "reason": "'Image' argument not passed."
             }
 
-        temp_image_path = _SERVER_STORAGE_DIR+image.filename
-
         log("Recieved request to detect shapes in " + image.filename)
-        log("Saving image to temp storage")
 
-        # Save the image to temp storage.
-        image.save(temp_image_path)
+        # Keep the upload in memory; it is decoded once inside detectShapes, so
+        # concurrent requests never share files on disk.
+        ext = os.path.splitext(image.filename)[1] or '.png'
 
         log("Running detection")
         # Detect shapes on the uploaded image.
-        jsonHierarchy, fullPrimitivesImg, containerImg, shapes = detectShapes(temp_image_path)
-
-        log("Detection finished with ["+str(len(shapes))+"] top level shapes. Cleaning up...")
+        jsonHierarchy, fullPrimitivesImg, containerImg, shapes = detectShapes(image.read(), ext=ext, annotate=False, concurrent=True, cache=_RESULT_CACHE)
 
-        # Clean the image after saving.
-        shutil.rmtree(_SERVER_STORAGE_DIR)
+        log("Detection finished with ["+str(len(jsonHierarchy))+"] top level shapes.")
 
         return jsonHierarchy
 
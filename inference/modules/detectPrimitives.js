@@ -11,6 +11,33 @@ const path = require('path');
 // Configuration.
 const _DETECT_SCRIPT_PATH = "../../detection/src/shapeDetect.py";
 const _WEB_API_ENDPOINT = process.env.SHAPE_DETECT_WEB_API_ENDPOINT || false;
+const _USE_PERSISTENT_WORKER = process.env.SHAPE_DETECT_SPAWN_PER_IMAGE ? false : true;
+
+// Long-lived detection process, shared across calls so that the Python imports
+// and YOLO network load are only paid once.
+var detectionWorker = null;
+
+// Performs shape detection by sending a job to the persistent detection worker.
+const detectViaWorker = async imagePath => {
+
+  log("Detecting shapes (worker) for "+ imagePath);
+
+  if (!detectionWorker) detectionWorker = NodePyInt.worker(
+    path.resolve(__dirname,_DETECT_SCRIPT_PATH),
+    ['--serve-stdio'], {
+      pythonCmd : 'python3'
+    });
+
+  var output = {};
+
+  try {
+    output = await detectionWorker({ image: path.resolve(imagePath) });
+  } catch(e){
+    log("Error detecting shapes: ", e);
+  }
+
+  return output;
+}
 
 // Performs shape detection using standard streams.
 const detectViaStandardStream = async imagePath => {
@@ -57,8 +84,10 @@ const detectViaAPI = imagePath => new Promise((resolve, reject) => {
 
 // Depending on whether the _WEB_API_ENDPOINT is set (indicating a server is running
 // and ready to receive requests to construct a shape hierarchy), choose to detect
-// shapes via the web API, or standard streams.
-module.exports = async (imagePath) => _WEB_API_ENDPOINT ? await detectViaAPI(imagePath) : await detectViaStandardStream(imagePath);
+// shapes via the web API, or standard streams. Standard streams use the persistent
+// worker unless SHAPE_DETECT_SPAWN_PER_IMAGE is set.
+module.exports = async (imagePath) => _WEB_API_ENDPOINT ? await detectViaAPI(imagePath) :
+  _USE_PERSISTENT_WORKER ? await detectViaWorker(imagePath) : await detectViaStandardStream(imagePath);
 
 
 // Utility functions.
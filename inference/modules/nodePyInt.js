@@ -76,6 +76,112 @@ module.exports = (path, args, ops) => {
 }
 
 
+}
+
+/**
+ * Persistent variant of the interface above, for scripts supporting a
+ * line-delimited JSON worker mode (e.g. `shapeDetect.py --serve-stdio`).
+ *
+ * A single Python process is spawned lazily and kept alive across calls. Each
+ * call writes one JSON job per line to the script's STDIN, tagged with an id,
+ * and is resolved when the line carrying the same id is read back from STDOUT.
+ * If the process exits, pending jobs are rejected and the next call spawns a
+ * fresh process.
+ */
+module.exports.worker = (path, args, ops) => {
+
+  if (!args) args = [];
+
+  log(`Instantiated persistent NodePyInt worker with path ${path} and args ${args}`);
+
+  var pyProc = null;
+  var pending = {};
+  var nextJobId = 0;
+  var buffered = "";
+
+  const rejectAll = (reason) => {
+    Object.keys(pending).forEach(id => pending[id].reject(reason));
+    pending = {};
+  };
+
+  // Only keep the Node event loop alive while jobs are in flight, so that an
+  // idle worker does not prevent the parent process from exiting.
+  const updateRef = () => {
+    if (!pyProc) return;
+    var method = Object.keys(pending).length > 0 ? 'ref' : 'unref';
+    [pyProc, pyProc.stdin, pyProc.stdout, pyProc.stderr].forEach(handle => handle[method]());
+  };
+
+  const start = () => {
+
+    var spawnOps = (ops && ops.cwd ? {cwd: ops.cwd} : {});
+
+    const proc = spawn((ops && ops.pythonCmd ? ops.pythonCmd : "python3"), [path, ...args], spawnOps);
+    pyProc = proc;
+
+    buffered = "";
+
+    // Stops using the process (so that the next call spawns a fresh one) and
+    // rejects the jobs in flight. Events from a process which has already been
+    // replaced are ignored, so they do not reject jobs sent to its successor.
+    const retire = (reason) => {
+      if (pyProc !== proc) return;
+      pyProc = null;
+      proc.kill();
+      rejectAll(reason);
+    };
+
+    // Responses may be split across (or share) chunks, so we only handle
+    // complete lines.
+    proc.stdout.on('data', (data) => {
+      if (pyProc !== proc) return;
+      buffered += data.toString('utf8');
+      var lines = buffered.split('\n');
+      buffered = lines.pop();
+
+      lines.filter(line => line.trim() !== "").forEach(line => {
+        var response;
+        try {
+          response = JSON.parse(line);
+        } catch(e){
+          log(`Warning: Data returned by ${path} is not in JSON format:`, line);
+          return;
+        }
+
+        var job = pending[response.id];
+        if (!job) return;
+        delete pending[response.id];
+
+        if (response.success) job.resolve(response.result);
+        else job.reject(response.reason);
+      });
+
+      updateRef();
+    });
+
+    proc.stderr.on('data', data => log(`${path} stderr: ${data.toString('utf8')}`));
+
+    proc.on('close', () => retire(`${path} worker exited.`));
+
+    proc.on('error', (err) => retire(err));
+
+    // Writing a job after the process has died (but before its exit has been
+    // handled) fails with EPIPE, which would otherwise crash the server as an
+    // unhandled 'error' event.
+    proc.stdin.on('error', (err) => retire(err));
+  };
+
+  return (data) => new Promise((resolve, reject) => {
+
+    if (!pyProc) start();
+
+    var id = nextJobId++;
+    pending[id] = { resolve, reject };
+    updateRef();
+
+    pyProc.stdin.write(JSON.stringify(Object.assign({}, data, { id })) + '\n');
+  });
+
 }
 
 function log(msg){